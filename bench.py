@@ -0,0 +1,454 @@
+# -*- coding: utf-8 -*-
+"""
+Offline throughput benchmark.
+
+Starts a local stand-in for Instagram's /graphql/query/ endpoint in a
+subprocess, then scrapes synthetic reels from it with run_batch() for every
+RPS x concurrency combination, each in a fresh process so peak RSS and CPU
+time are per run. Nothing is sent to Instagram.
+
+    python3 bench.py --rps 20,100 --concurrency 1,4,16
+    python3 bench.py --latency-ms 50 --throttle-rate 0.02 --error-rate 0.01
+    python3 bench.py --codecs json,orjson,msgspec  # CPU per 10k comments per JSON backend
+    python3 bench.py --output current.json --baseline previous.json
+    python3 bench.py serve --port 8765          # stand-in server only
+    python3 bench.py memory --comments 1000000  # bytes held per comment by each record layout
+
+Unix only (uses the resource module for RSS/CPU accounting).
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+import codec
+
+GRAPHQL_PATH = "/graphql/query/"
+DEFAULT_PAGES = 20
+DEFAULT_PAGE_SIZE = 50
+DEFAULT_REELS = 8
+DEFAULT_RPS = "20,100"
+DEFAULT_CONCURRENCY = "1,4"
+DEFAULT_TOLERANCE = 0.15
+
+# ---------------------------------------------------------------------------
+# Stand-in server
+# ---------------------------------------------------------------------------
+
+@lru_cache(maxsize=4096)
+def comment_page(shortcode: str, page: int, pages: int, page_size: int, text_len: int, total: int) -> bytes:
+    """
+    One edge_media_to_parent_comment page, shaped like the real response.
+    `total` is the reel's comment count, whatever page size the client asked for.
+    """
+    base = page * page_size
+    edges = [{
+        "node": {
+            "id": f"{shortcode}{base + i:012d}",
+            "text": (f"comment {base + i} " + "x" * text_len)[:text_len],
+            "created_at": 1700000000 - base - i,
+            "owner": {"id": str(1000 + (base + i) % 997), "username": f"user{(base + i) % 997}"},
+            "edge_liked_by": {"count": (base + i) % 13},
+            "edge_threaded_comments": {"count": 0, "edges": [],
+                                       "page_info": {"has_next_page": False, "end_cursor": None}},
+        }
+    } for i in range(page_size)]
+    has_next = page + 1 < pages
+    body = {"data": {"shortcode_media": {"edge_media_to_parent_comment": {
+        "count": total,
+        "page_info": {"has_next_page": has_next, "end_cursor": str(page + 1) if has_next else None},
+        "edges": edges,
+    }}}, "status": "ok"}
+    return json.dumps(body, separators=(",", ":")).encode("utf-8")
+
+class FakeGraphQLHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out as separate writes; without TCP_NODELAY every
+    # response would pay a delayed-ACK stall on keep-alive connections.
+    disable_nagle_algorithm = True
+
+    def _reply(self, status: int, body: bytes, headers: Optional[Dict[str, str]] = None):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        cfg = self.server.cfg
+        url = urlparse(self.path)
+        if url.path != GRAPHQL_PATH:
+            self._reply(404, b'{"status":"fail"}')
+            return
+        if cfg.latency_ms > 0:
+            time.sleep(cfg.latency_ms / 1000.0)
+        roll = self.server.rng.random()
+        if roll < cfg.throttle_rate:
+            self._reply(429, b'{"status":"fail","message":"Please wait a few minutes"}',
+                        {"Retry-After": str(cfg.retry_after)})
+            return
+        if roll < cfg.throttle_rate + cfg.error_rate:
+            self._reply(500, b'{"status":"fail"}')
+            return
+        try:
+            variables = json.loads(parse_qs(url.query)["variables"][0])
+            shortcode = variables["shortcode"]
+            page = int(variables.get("after") or 0)
+        except (KeyError, ValueError):
+            self._reply(400, b'{"status":"fail"}')
+            return
+        page_size = min(int(variables.get("first") or cfg.page_size), cfg.page_size)
+        self._reply(200, comment_page(shortcode, page, cfg.pages, page_size, cfg.text_len, cfg.pages * cfg.page_size))
+
+    def log_message(self, format, *args):
+        pass
+
+def serve(cfg: argparse.Namespace):
+    server = ThreadingHTTPServer(("127.0.0.1", cfg.port), FakeGraphQLHandler)
+    server.daemon_threads = True
+    server.cfg = cfg
+    server.rng = random.Random(cfg.seed)
+    print(server.server_address[1], flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+def server_args(cfg: argparse.Namespace) -> List[str]:
+    return ["--pages", str(cfg.pages), "--page-size", str(cfg.page_size), "--text-len", str(cfg.text_len),
+            "--latency-ms", str(cfg.latency_ms), "--error-rate", str(cfg.error_rate),
+            "--throttle-rate", str(cfg.throttle_rate), "--retry-after", str(cfg.retry_after),
+            "--seed", str(cfg.seed)]
+
+def start_server(cfg: argparse.Namespace) -> Tuple[subprocess.Popen, str]:
+    proc = subprocess.Popen([sys.executable, os.path.abspath(__file__), "serve", "--port", "0"] + server_args(cfg),
+                            stdout=subprocess.PIPE, text=True)
+    port = proc.stdout.readline().strip()
+    if not port:
+        proc.kill()
+        raise RuntimeError("Stand-in server failed to start.")
+    return proc, f"http://127.0.0.1:{port}"
+
+# ---------------------------------------------------------------------------
+# One measured run (executed in its own process)
+# ---------------------------------------------------------------------------
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(pct / 100.0 * len(ordered))) - 1))]
+
+def peak_rss_mb() -> float:
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes.
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+def run_one(cfg: argparse.Namespace) -> Dict[str, Any]:
+    # Imported here so the stand-in server process stays light.
+    import main
+    from session import CredentialCache, NoCredentials, Session, SessionPool
+
+    class LatencyLog:
+        """Records the latency of every successful request for the percentiles."""
+
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.latencies: List[float] = []
+
+        def on_success(self, latency: float):
+            self.latencies.append(latency)
+            super().on_success(latency)
+
+    codec.use(cfg.codec)
+    base = main.AdaptiveRateLimiter if cfg.adaptive else main.RateLimiter
+    limiter = type("RecordingLimiter", (LatencyLog, base), {})(cfg.rps)
+    shortcodes = [f"BENCH{i:04d}" for i in range(cfg.reels)]
+
+    with tempfile.TemporaryDirectory(prefix="instascrape-bench-") as tmp:
+        # Exports, checkpoints and the (fake) cookie file all stay in the scratch dir.
+        os.chdir(tmp)
+        credentials = CredentialCache(fallback=("bench", "bench", "bench", "bench"), path=os.path.join(tmp, "cookie.json"))
+        pool = SessionPool([Session(credentials, NoCredentials(), limiter=limiter, name="bench")])
+        cpu0, t0 = time.process_time(), time.perf_counter()
+        results = asyncio.run(main.run_batch(shortcodes, None, cfg.rps, cfg.concurrency, formats=cfg.formats,
+                                             progress=False,
+                                             options=main.ScrapeOptions(pool=pool, base_url=cfg.base_url)))
+        seconds = time.perf_counter() - t0
+        cpu = time.process_time() - cpu0
+
+    comments = sum(r["comments"] for r in results if not r["error"])
+    pages = len(limiter.latencies)
+    return {
+        "codec": cfg.codec,
+        "rps": cfg.rps,
+        "concurrency": cfg.concurrency,
+        "reels": cfg.reels,
+        "failed_reels": sum(1 for r in results if r["error"]),
+        "requests": limiter.requests,
+        "pages": pages,
+        "comments": comments,
+        "seconds": round(seconds, 3),
+        "pages_per_s": round(pages / seconds, 2) if seconds else 0.0,
+        "comments_per_s": round(comments / seconds, 1) if seconds else 0.0,
+        "p50_ms": round(percentile(limiter.latencies, 50) * 1000, 2),
+        "p99_ms": round(percentile(limiter.latencies, 99) * 1000, 2),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+        "cpu_s_per_10k": round(cpu / comments * 10000, 3) if comments else 0.0,
+    }
+
+# ---------------------------------------------------------------------------
+# Suite
+# ---------------------------------------------------------------------------
+
+COLUMNS = [("codec", "codec"), ("rps", "rps"), ("concurrency", "conc"), ("pages_per_s", "pages/s"), ("comments_per_s", "comments/s"),
+           ("p50_ms", "p50 ms"), ("p99_ms", "p99 ms"), ("peak_rss_mb", "RSS MB"), ("cpu_s_per_10k", "CPU s/10k"),
+           ("failed_reels", "failed")]
+
+def cell(value: Any) -> str:
+    return f"{value:g}" if isinstance(value, float) else str(value)
+
+def print_table(rows: List[Dict[str, Any]], columns: List[Tuple[str, str]] = COLUMNS):
+    widths = [max(len(title), *(len(cell(r[key])) for r in rows)) for key, title in columns]
+    print("  ".join(title.rjust(w) for (_, title), w in zip(columns, widths)))
+    for r in rows:
+        print("  ".join(cell(r[key]).rjust(w) for (key, _), w in zip(columns, widths)))
+
+def run_key(r: Dict[str, Any]) -> Tuple[str, float, int]:
+    return r.get("codec", "json"), r["rps"], r["concurrency"]
+
+def compare(rows: List[Dict[str, Any]], baseline_path: str, tolerance: float) -> List[str]:
+    """Regressions against a previous --output file: slower throughput or more CPU per comment."""
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = {run_key(b): b for b in json.load(f)["runs"]}
+    problems = []
+    for r in rows:
+        b = baseline.get(run_key(r))
+        if b is None:
+            continue
+        label = f"codec={r['codec']} rps={r['rps']:g} concurrency={r['concurrency']}"
+        if r["comments_per_s"] < b["comments_per_s"] * (1 - tolerance):
+            problems.append(f"{label}: comments/s {b['comments_per_s']:g} -> {r['comments_per_s']:g}")
+        if b["cpu_s_per_10k"] and r["cpu_s_per_10k"] > b["cpu_s_per_10k"] * (1 + tolerance):
+            problems.append(f"{label}: CPU s/10k {b['cpu_s_per_10k']:g} -> {r['cpu_s_per_10k']:g}")
+        if r["failed_reels"] > b["failed_reels"]:
+            problems.append(f"{label}: failed reels {b['failed_reels']} -> {r['failed_reels']}")
+    return problems
+
+def run_suite(cfg: argparse.Namespace) -> int:
+    proc, base_url = start_server(cfg)
+    rows: List[Dict[str, Any]] = []
+    try:
+        for name in cfg.codecs:
+            for rps in cfg.rps:
+                for concurrency in cfg.concurrency:
+                    cmd = [sys.executable, os.path.abspath(__file__), "run-one", "--base-url", base_url,
+                           "--codec", name, "--rps", f"{rps:g}", "--concurrency", str(concurrency),
+                           "--reels", str(cfg.reels), "--formats", ",".join(cfg.formats)]
+                    cmd += ["--adaptive"] if cfg.adaptive else []
+                    label = f"codec={name} rps={rps:g} concurrency={concurrency}"
+                    print(f"Running {label}...", file=sys.stderr)
+                    out = subprocess.run(cmd, capture_output=True, text=True)
+                    if out.returncode != 0:
+                        sys.stderr.write(out.stderr)
+                        raise RuntimeError(f"Benchmark run failed ({label}).")
+                    rows.append(json.loads(out.stdout.strip().splitlines()[-1]))
+    finally:
+        proc.terminate()
+        proc.wait()
+
+    print_table(rows)
+    if cfg.output:
+        with open(cfg.output, "w", encoding="utf-8") as f:
+            json.dump({"generated_at": int(time.time()), "server": vars_for_output(cfg), "runs": rows}, f, indent=2)
+        print(f"Results saved to {cfg.output}")
+    if cfg.baseline:
+        problems = compare(rows, cfg.baseline, cfg.tolerance)
+        for p in problems:
+            print(f" ! regression: {p}")
+        if problems:
+            return 1
+        print(f"No regressions against {cfg.baseline} (tolerance {cfg.tolerance:.0%}).")
+    return 0
+
+# ---------------------------------------------------------------------------
+# Memory per comment
+# ---------------------------------------------------------------------------
+
+# bytes per comment == MB per million comments
+MEMORY_COLUMNS = [("layout", "layout"), ("comments", "comments"), ("bytes_per_comment", "bytes/comment"),
+                  ("saved_mb_per_million", "saved MB/1M"), ("build_s", "build s")]
+
+def legacy_records(raw: bytes) -> Tuple[List[str], List[Dict[str, Any]]]:
+    """What the original parse_parent_comments() kept per page: a dict and a "user: text" line per comment."""
+    flat, struct = [], []
+    for edge in json.loads(raw)["data"]["shortcode_media"]["edge_media_to_parent_comment"]["edges"]:
+        node = edge.get("node", {})
+        user = node.get("owner", {}).get("username", "")
+        flat.append(f"{user}: {node.get('text', '')}")
+        struct.append({"username": user, "text": node.get("text", ""), "created_at": node.get("created_at")})
+    return flat, struct
+
+def measure_layout(layout: str, pages: int, page_size: int, text_len: int) -> Dict[str, Any]:
+    # Numeric shortcode prefix: ids look like real (all-digit) comment ids.
+    raws = [comment_page("1790", p, pages, page_size, text_len, pages * page_size) for p in range(min(pages, 64))]
+    codec._USERNAMES.clear()
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    if layout == "dict":
+        kept: Any = ([], [])
+        for p in range(pages):
+            flat, struct = legacy_records(raws[p % len(raws)])
+            kept[0].extend(flat)
+            kept[1].extend(struct)
+    elif layout == "comment":
+        kept = []
+        for p in range(pages):
+            kept.extend(codec.decode_parent_page(raws[p % len(raws)]).comments)
+    else:
+        kept = codec.CommentBuffer()
+        for p in range(pages):
+            kept.extend(codec.decode_parent_page(raws[p % len(raws)]).comments)
+    seconds = time.perf_counter() - t0
+    held = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del kept
+    comments = pages * page_size
+    return {"layout": layout, "codec": codec.BACKEND, "comments": comments,
+            "bytes_per_comment": round(held / comments, 1), "build_s": round(seconds, 2)}
+
+def run_memory(cfg: argparse.Namespace) -> int:
+    """
+    Python heap held per comment (tracemalloc) once `--comments` comments are
+    kept in memory as the original dicts + text lines, as slotted Comment
+    records, and in a CommentBuffer. Each layout runs in its own process.
+    """
+    pages = max(1, cfg.comments // cfg.page_size)
+    rows = []
+    for layout in ("dict", "comment", "buffer"):
+        print(f"Measuring {layout}...", file=sys.stderr)
+        cmd = [sys.executable, os.path.abspath(__file__), "memory-one", layout, str(pages),
+               "--page-size", str(cfg.page_size), "--text-len", str(cfg.text_len)]
+        out = subprocess.run(cmd, capture_output=True, text=True)
+        if out.returncode != 0:
+            sys.stderr.write(out.stderr)
+            raise RuntimeError(f"Memory run failed ({layout}).")
+        rows.append(json.loads(out.stdout.strip().splitlines()[-1]))
+    base = rows[0]["bytes_per_comment"]
+    for r in rows:
+        r["saved_mb_per_million"] = round(base - r["bytes_per_comment"], 1)
+    print_table(rows, MEMORY_COLUMNS)
+    if cfg.output:
+        with open(cfg.output, "w", encoding="utf-8") as f:
+            json.dump({"generated_at": int(time.time()), "memory": rows}, f, indent=2)
+        print(f"Results saved to {cfg.output}")
+    return 0
+
+def vars_for_output(cfg: argparse.Namespace) -> Dict[str, Any]:
+    keys = ("pages", "page_size", "text_len", "latency_ms", "error_rate", "throttle_rate", "retry_after", "seed",
+            "reels", "formats", "adaptive")
+    return {k: getattr(cfg, k) for k in keys}
+
+def float_list(value: str) -> List[float]:
+    try:
+        return [float(v) for v in value.split(",") if v.strip()]
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected comma-separated numbers")
+
+def int_list(value: str) -> List[int]:
+    try:
+        return [int(v) for v in value.split(",") if v.strip()]
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected comma-separated integers")
+
+def add_server_args(ap: argparse.ArgumentParser):
+    ap.add_argument("--pages", type=int, default=DEFAULT_PAGES, help="comment pages per reel")
+    ap.add_argument("--page-size", type=int, default=DEFAULT_PAGE_SIZE, help="comments per page")
+    ap.add_argument("--text-len", type=int, default=80, help="characters per comment text")
+    ap.add_argument("--latency-ms", type=float, default=0.0, help="added server latency per request")
+    ap.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with HTTP 500")
+    ap.add_argument("--throttle-rate", type=float, default=0.0, help="fraction of requests answered with HTTP 429")
+    ap.add_argument("--retry-after", type=int, default=1, help="Retry-After seconds sent with injected 429s")
+    ap.add_argument("--seed", type=int, default=1, help="seed for error/429 injection")
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    ap = argparse.ArgumentParser(description="Offline InstaScrape benchmark against a local GraphQL stand-in")
+    sub = ap.add_subparsers(dest="command")
+
+    add_server_args(ap)
+    ap.add_argument("--rps", type=float_list, default=float_list(DEFAULT_RPS), help="comma-separated RPS limits")
+    ap.add_argument("--concurrency", type=int_list, default=int_list(DEFAULT_CONCURRENCY),
+                    help="comma-separated reel concurrency values")
+    ap.add_argument("--reels", type=int, default=DEFAULT_REELS, help="synthetic reels per run")
+    ap.add_argument("--formats", default="txt,json", help="output formats written during the run")
+    ap.add_argument("--codecs", default=codec.BACKEND,
+                    help=f"comma-separated JSON backends to compare (installed: {','.join(codec.available_backends())})")
+    ap.add_argument("--adaptive", action="store_true", help="use the adaptive limiter instead of a fixed rate")
+    ap.add_argument("--output", metavar="FILE", help="save results as JSON (usable as a later --baseline)")
+    ap.add_argument("--baseline", metavar="FILE", help="compare with a previous --output and exit 1 on regressions")
+    ap.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE, help="allowed relative slowdown")
+
+    sp = sub.add_parser("serve", help="run only the stand-in server and print its port")
+    sp.add_argument("--port", type=int, default=8765)
+    add_server_args(sp)
+
+    mp = sub.add_parser("memory", help="compare memory held per comment by each in-memory record layout")
+    mp.add_argument("--comments", type=int, default=1_000_000, help="comments kept in memory per layout")
+    mp.add_argument("--page-size", type=int, default=DEFAULT_PAGE_SIZE, help="comments per decoded page")
+    mp.add_argument("--text-len", type=int, default=80, help="characters per comment text")
+    mp.add_argument("--output", metavar="FILE", help="save results as JSON")
+
+    op = sub.add_parser("memory-one", help=argparse.SUPPRESS)
+    op.add_argument("layout", choices=("dict", "comment", "buffer"))
+    op.add_argument("pages", type=int)
+    op.add_argument("--page-size", type=int, default=DEFAULT_PAGE_SIZE)
+    op.add_argument("--text-len", type=int, default=80)
+
+    rp = sub.add_parser("run-one", help=argparse.SUPPRESS)
+    rp.add_argument("--base-url", required=True)
+    rp.add_argument("--rps", type=float, required=True)
+    rp.add_argument("--concurrency", type=int, required=True)
+    rp.add_argument("--reels", type=int, default=DEFAULT_REELS)
+    rp.add_argument("--formats", default="txt,json")
+    rp.add_argument("--codec", default=codec.BACKEND)
+    rp.add_argument("--adaptive", action="store_true")
+
+    cfg = ap.parse_args(argv)
+    if isinstance(cfg.formats, str):
+        cfg.formats = tuple(f.strip() for f in cfg.formats.split(",") if f.strip())
+    if cfg.command is None:
+        cfg.codecs = [c.strip() for c in cfg.codecs.split(",") if c.strip()]
+        missing = [c for c in cfg.codecs if c not in codec.available_backends()]
+        if missing:
+            ap.error(f"JSON backend(s) not installed: {', '.join(missing)}")
+    return cfg
+
+def main():
+    cfg = parse_args()
+    if cfg.command == "serve":
+        serve(cfg)
+    elif cfg.command == "run-one":
+        print(json.dumps(run_one(cfg)), flush=True)
+    elif cfg.command == "memory":
+        sys.exit(run_memory(cfg))
+    elif cfg.command == "memory-one":
+        print(json.dumps(measure_layout(cfg.layout, cfg.pages, cfg.page_size, cfg.text_len)), flush=True)
+    else:
+        sys.exit(run_suite(cfg))
+
+if __name__ == "__main__":
+    main()
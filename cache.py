@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+On-disk cache of GraphQL response bodies, shared by runs (and worker processes)
+that ask for the same pages shortly after each other.
+
+Entries are keyed by query_hash plus the compact variables JSON that
+graphql_request() sends, expire after their own TTL and are evicted least
+recently used first once the cache outgrows its size limit. Expired entries
+that came with an ETag or Last-Modified are kept for conditional revalidation.
+"""
+
+import json
+import os
+import sqlite3
+import time
+from typing import Any, Dict, NamedTuple, Optional
+
+DEFAULT_CACHE_PATH = os.path.join("download_comments", "cache.sqlite")
+DEFAULT_CACHE_TTL = 600.0
+DEFAULT_CACHE_MB = 256
+
+def cache_key(query_hash: str, variables: Dict[str, Any]) -> str:
+    return query_hash + ":" + json.dumps(variables, separators=(",", ":"))
+
+class CacheEntry(NamedTuple):
+    body: bytes
+    etag: Optional[str]
+    last_modified: Optional[str]
+    expires_at: float
+
+    @property
+    def fresh(self) -> bool:
+        return time.time() < self.expires_at
+
+    def validators(self) -> Dict[str, str]:
+        """Conditional request headers for revalidating this entry."""
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+class ResponseCache:
+    """
+    SQLite-backed response store. With `bypass`, lookups always miss but fresh
+    responses are still stored, so a forced refresh also refreshes the cache.
+    """
+
+    def __init__(self, path: str = DEFAULT_CACHE_PATH, ttl: float = DEFAULT_CACHE_TTL,
+                 max_bytes: int = DEFAULT_CACHE_MB * 1024 * 1024, bypass: bool = False):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.bypass = bypass
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._db = sqlite3.connect(path, timeout=30, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, body BLOB NOT NULL, etag TEXT, "
+            "last_modified TEXT, expires_at REAL NOT NULL, last_used REAL NOT NULL, size INTEGER NOT NULL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS idx_responses_last_used ON responses (last_used)")
+
+    def get(self, key: str) -> Optional[CacheEntry]:
+        """The entry for `key`, fresh or revalidatable; None on a miss (or when bypassing)."""
+        if self.bypass:
+            return None
+        row = self._db.execute("SELECT body, etag, last_modified, expires_at FROM responses WHERE key = ?",
+                               (key,)).fetchone()
+        if row is None:
+            return None
+        entry = CacheEntry(*row)
+        if not entry.fresh and not (entry.etag or entry.last_modified):
+            self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+            return None
+        self._db.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+        return entry
+
+    def put(self, key: str, body: bytes, etag: Optional[str] = None, last_modified: Optional[str] = None,
+            ttl: Optional[float] = None):
+        now = time.time()
+        self._db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                         (key, body, etag, last_modified, now + (self.ttl if ttl is None else ttl), now, len(body)))
+        self._evict()
+
+    def refresh(self, key: str, ttl: Optional[float] = None):
+        """Restart the TTL of an entry the server just confirmed unchanged (HTTP 304)."""
+        now = time.time()
+        self._db.execute("UPDATE responses SET expires_at = ?, last_used = ? WHERE key = ?",
+                         (now + (self.ttl if ttl is None else ttl), now, key))
+
+    def _evict(self):
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # Drop least recently used entries until the cache is back under its limit.
+        excess = total - self.max_bytes
+        freed = 0
+        doomed = []
+        for key, size in self._db.execute("SELECT key, size FROM responses ORDER BY last_used"):
+            doomed.append((key,))
+            freed += size
+            if freed >= excess:
+                break
+        self._db.executemany("DELETE FROM responses WHERE key = ?", doomed)
+
+    def clear(self):
+        self._db.execute("DELETE FROM responses")
+
+    def close(self):
+        self._db.close()
@@ -0,0 +1,380 @@
+# -*- coding: utf-8 -*-
+"""
+JSON handling for GraphQL pages and exports.
+
+The fastest installed backend is used: msgspec (decodes straight into typed
+structs, skipping every field we do not keep), then orjson, then the stdlib.
+Set INSTASCRAPE_JSON=msgspec|orjson|json, or call use(), to pick one.
+"""
+
+import json
+import os
+from array import array
+from typing import Any, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple, Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+BACKEND_ENV = "INSTASCRAPE_JSON"
+MAX_INTERNED = 200_000
+CHUNK_ROWS = 4096
+
+class ShapeError(ValueError):
+    """The response parsed as JSON but is not the page we asked for."""
+
+_USERNAMES: Dict[str, str] = {}
+
+def intern_username(name: str) -> str:
+    """
+    One shared str per distinct username; big reels repeat the same few
+    thousand names over and over. Bounded (unlike sys.intern) for long-lived processes.
+    """
+    shared = _USERNAMES.get(name)
+    if shared is None:
+        if len(_USERNAMES) >= MAX_INTERNED:
+            _USERNAMES.clear()
+        shared = _USERNAMES[name] = name
+    return shared
+
+class Comment:
+    """
+    One exported comment. Slotted to keep big reels small in memory; get() and
+    [] mirror the dict records the sinks and the NDJSON reader also handle.
+    """
+
+    __slots__ = ("id", "username", "text", "created_at", "replies")
+
+    def __init__(self, id: Optional[str], username: str = "", text: str = "", created_at: Optional[int] = None,
+                 replies: Optional[List["Comment"]] = None):
+        self.id = id
+        self.username = username
+        self.text = text
+        self.created_at = created_at
+        self.replies = replies
+
+    @classmethod
+    def from_node(cls, node: Dict[str, Any]) -> "Comment":
+        return cls(node.get("id"), intern_username((node.get("owner") or {}).get("username", "")),
+                   node.get("text", ""), node.get("created_at"))
+
+    def get(self, key: str, default: Any = None) -> Any:
+        if key not in Comment.__slots__:
+            return default
+        value = getattr(self, key)
+        return default if value is None and key == "replies" else value
+
+    def __getitem__(self, key: str) -> Any:
+        if key not in Comment.__slots__ or (key == "replies" and self.replies is None):
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key: str, value: Any):
+        if key not in Comment.__slots__:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def to_dict(self) -> Dict[str, Any]:
+        d = {"id": self.id, "username": self.username, "text": self.text, "created_at": self.created_at}
+        if self.replies is not None:
+            d["replies"] = [r.to_dict() if isinstance(r, Comment) else r for r in self.replies]
+        return d
+
+    def __repr__(self) -> str:
+        return f"Comment({self.to_dict()!r})"
+
+_MISSING = -(2 ** 63)
+
+def _packed_id(value: Any) -> int:
+    """Numeric ids (all real comment ids) as int64; _MISSING for anything that would not round-trip."""
+    if (isinstance(value, str) and 0 < len(value) < 19 and value.isascii() and value.isdigit()
+            and (value[0] != "0" or value == "0")):
+        return int(value)
+    return _MISSING
+
+class _Chunk:
+    __slots__ = ("ids", "usernames", "texts", "created", "extra", "replies")
+
+    def __init__(self):
+        self.ids = array("q")
+        self.usernames: List[str] = []
+        self.texts: List[str] = []
+        self.created = array("q")
+        self.extra: Dict[Tuple[int, str], Any] = {}  # (row, field) values that do not fit the int64 columns
+        self.replies: Dict[int, list] = {}
+
+class CommentBuffer:
+    """
+    Append-only, chunked column store for holding many comments in memory.
+
+    Rows go into fixed-size chunks of columns: numeric ids and created_at in
+    int64 arrays, interned usernames and texts in plain lists, so a comment
+    costs a few machine words instead of a full object. Comment objects are
+    only built while reading; pages() yields them a chunk at a time for
+    Sink.write_page(), which serializes them to the usual JSON/TXT formats.
+    """
+
+    def __init__(self, chunk_rows: int = CHUNK_ROWS):
+        self.chunk_rows = chunk_rows
+        self._chunks: List[_Chunk] = []
+        self._len = 0
+
+    def append(self, comment: Any):
+        """Store a Comment (or a dict record with the same keys)."""
+        if not self._chunks or len(self._chunks[-1].texts) >= self.chunk_rows:
+            self._chunks.append(_Chunk())
+        chunk = self._chunks[-1]
+        row = len(chunk.texts)
+        cid = comment.get("id")
+        packed = _packed_id(cid)
+        chunk.ids.append(packed)
+        if packed == _MISSING and cid is not None:
+            chunk.extra[row, "id"] = cid
+        username = comment.get("username")
+        chunk.usernames.append(intern_username(username) if isinstance(username, str) else username)
+        chunk.texts.append(comment.get("text"))
+        created = comment.get("created_at")
+        if type(created) is int and _MISSING < created < 2 ** 63:
+            chunk.created.append(created)
+        else:
+            chunk.created.append(_MISSING)
+            if created is not None:
+                chunk.extra[row, "created_at"] = created
+        replies = comment.get("replies")
+        if replies is not None:
+            chunk.replies[row] = replies
+        self._len += 1
+
+    def extend(self, comments: Iterable[Any]):
+        for c in comments:
+            self.append(c)
+
+    def __len__(self) -> int:
+        return self._len
+
+    @staticmethod
+    def _row(chunk: _Chunk, row: int) -> Comment:
+        cid = chunk.ids[row]
+        created = chunk.created[row]
+        return Comment(str(cid) if cid != _MISSING else chunk.extra.get((row, "id")),
+                       chunk.usernames[row], chunk.texts[row],
+                       created if created != _MISSING else chunk.extra.get((row, "created_at")),
+                       chunk.replies.get(row))
+
+    def __getitem__(self, index: Union[int, slice]) -> Union[Comment, List[Comment]]:
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self._len))]
+        if index < 0:
+            index += self._len
+        if not 0 <= index < self._len:
+            raise IndexError("CommentBuffer index out of range")
+        return self._row(self._chunks[index // self.chunk_rows], index % self.chunk_rows)
+
+    def pages(self) -> Iterator[List[Comment]]:
+        for chunk in self._chunks:
+            yield [self._row(chunk, row) for row in range(len(chunk.texts))]
+
+    def __iter__(self) -> Iterator[Comment]:
+        for page in self.pages():
+            yield from page
+
+    def write_to(self, sink):
+        for page in self.pages():
+            sink.write_page(page)
+
+# Parent id -> (replies inlined in the page, has more, end_cursor).
+Threads = Dict[str, Tuple[List[Comment], bool, Optional[str]]]
+
+class ParentPage(NamedTuple):
+    count: int
+    has_next: bool
+    end_cursor: Optional[str]
+    comments: List[Comment]
+    threads: Threads
+
+class ChildPage(NamedTuple):
+    has_next: bool
+    end_cursor: Optional[str]
+    comments: List[Comment]
+
+def _default(obj: Any) -> Any:
+    if isinstance(obj, Comment):
+        return obj.to_dict()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+# ---------------------------------------------------------------------------
+# Generic dict walkers (stdlib json and orjson)
+# ---------------------------------------------------------------------------
+
+def _walk_threads(edges: List[Dict[str, Any]]) -> Threads:
+    threads: Threads = {}
+    for edge in edges:
+        node = edge.get("node") or {}
+        thread = node.get("edge_threaded_comments") or {}
+        if not node.get("id") or not thread.get("count"):
+            continue
+        inline = [Comment.from_node(e.get("node") or {}) for e in thread.get("edges") or []]
+        page_info = thread.get("page_info") or {}
+        if inline:
+            threads[node["id"]] = (inline, bool(page_info.get("has_next_page")), page_info.get("end_cursor"))
+        else:
+            threads[node["id"]] = ([], True, None)
+    return threads
+
+def _walk_parent(data: Any, threads: bool) -> ParentPage:
+    try:
+        conn = data["data"]["shortcode_media"]["edge_media_to_parent_comment"]
+        edges = conn["edges"]
+        page_info = conn["page_info"]
+    except (KeyError, TypeError):
+        raise ShapeError("missing comment edges")
+    count = conn.get("count")
+    return ParentPage(count if isinstance(count, int) and count >= 0 else 0,
+                      bool(page_info.get("has_next_page")), page_info.get("end_cursor"),
+                      [Comment.from_node(e.get("node") or {}) for e in edges],
+                      _walk_threads(edges) if threads else {})
+
+def _walk_child(data: Any) -> ChildPage:
+    try:
+        conn = data["data"]["comment"]["edge_threaded_comments"]
+        edges = conn["edges"]
+        page_info = conn["page_info"]
+    except (KeyError, TypeError):
+        raise ShapeError("missing reply edges")
+    return ChildPage(bool(page_info.get("has_next_page")), page_info.get("end_cursor"),
+                     [Comment.from_node(e.get("node") or {}) for e in edges])
+
+def _json_loads(raw: bytes) -> Any:
+    return json.loads(raw)
+
+def _json_dumps(obj: Any) -> bytes:
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"), default=_default).encode("utf-8")
+
+def _orjson_dumps(obj: Any) -> bytes:
+    return orjson.dumps(obj, default=_default)
+
+def _generic_parent(raw: bytes, threads: bool = False) -> ParentPage:
+    return _walk_parent(loads(raw), threads)
+
+def _generic_child(raw: bytes) -> ChildPage:
+    return _walk_child(loads(raw))
+
+# ---------------------------------------------------------------------------
+# msgspec: typed structs holding only the fields we keep
+# ---------------------------------------------------------------------------
+
+if msgspec is not None:
+    Number = Union[int, float, None]
+
+    class _Owner(msgspec.Struct):
+        username: Optional[str] = ""
+
+    class _PageInfo(msgspec.Struct):
+        has_next_page: Optional[bool] = False
+        end_cursor: Optional[str] = None
+
+    class _ReplyNode(msgspec.Struct):
+        id: Union[str, int, None] = None
+        text: Optional[str] = ""
+        created_at: Number = None
+        owner: Optional[_Owner] = None
+
+    class _ReplyEdge(msgspec.Struct):
+        node: Optional[_ReplyNode] = None
+
+    class _ReplyConnection(msgspec.Struct):
+        count: Number = 0
+        page_info: Optional[_PageInfo] = None
+        edges: Optional[List[_ReplyEdge]] = None
+
+    class _ThreadedNode(_ReplyNode):
+        edge_threaded_comments: Optional[_ReplyConnection] = None
+
+    def _parent_response(node_type):
+        edge = msgspec.defstruct("_Edge", [("node", Optional[node_type], None)])
+        conn = msgspec.defstruct("_Connection", [("page_info", _PageInfo), ("edges", List[edge]),
+                                                 ("count", Number, None)])
+        media = msgspec.defstruct("_Media", [("edge_media_to_parent_comment", conn)])
+        data = msgspec.defstruct("_ParentData", [("shortcode_media", media)])
+        return msgspec.defstruct("_ParentResponse", [("data", data)])
+
+    class _ChildComment(msgspec.Struct):
+        edge_threaded_comments: _ReplyConnection
+
+    class _ChildData(msgspec.Struct):
+        comment: _ChildComment
+
+    class _ChildResponse(msgspec.Struct):
+        data: _ChildData
+
+    _PARENT_DECODERS = {
+        False: msgspec.json.Decoder(_parent_response(_ReplyNode)),
+        True: msgspec.json.Decoder(_parent_response(_ThreadedNode)),
+    }
+    _CHILD_DECODER = msgspec.json.Decoder(_ChildResponse)
+    _ENCODER = msgspec.json.Encoder(enc_hook=_default)
+
+    def _comment(node: Optional[_ReplyNode]) -> Comment:
+        if node is None:
+            return Comment(None)
+        owner = node.owner
+        return Comment(node.id, intern_username((owner.username if owner else "") or ""), node.text, node.created_at)
+
+    def _msgspec_decode(decoder, raw: bytes, what: str):
+        try:
+            return decoder.decode(raw)
+        except msgspec.ValidationError as e:
+            raise ShapeError(f"missing {what} ({e})")
+
+    def _msgspec_parent(raw: bytes, threads: bool = False) -> ParentPage:
+        conn = _msgspec_decode(_PARENT_DECODERS[threads], raw, "comment edges").data.shortcode_media.edge_media_to_parent_comment
+        comments = [_comment(e.node) for e in conn.edges]
+        found: Threads = {}
+        if threads:
+            for e in conn.edges:
+                node, thread = e.node, e.node.edge_threaded_comments if e.node else None
+                if node is None or not node.id or thread is None or not thread.count:
+                    continue
+                inline = [_comment(r.node) for r in thread.edges or []]
+                page_info = thread.page_info or _PageInfo()
+                found[node.id] = (inline, bool(page_info.has_next_page), page_info.end_cursor) if inline else ([], True, None)
+        count = conn.count if isinstance(conn.count, int) and conn.count >= 0 else 0
+        return ParentPage(count, bool(conn.page_info.has_next_page), conn.page_info.end_cursor, comments, found)
+
+    def _msgspec_child(raw: bytes) -> ChildPage:
+        conn = _msgspec_decode(_CHILD_DECODER, raw, "reply edges").data.comment.edge_threaded_comments
+        page_info = conn.page_info or _PageInfo()
+        return ChildPage(bool(page_info.has_next_page), page_info.end_cursor, [_comment(e.node) for e in conn.edges or []])
+
+# ---------------------------------------------------------------------------
+# Backend selection
+# ---------------------------------------------------------------------------
+
+def available_backends() -> List[str]:
+    return [name for name, mod in (("msgspec", msgspec), ("orjson", orjson)) if mod is not None] + ["json"]
+
+def use(name: str):
+    """Switch every codec function to backend `name` ("msgspec", "orjson" or "json")."""
+    global BACKEND, loads, dumps, decode_parent_page, decode_child_page
+    if name not in available_backends():
+        raise ValueError(f"JSON backend {name!r} is not available (installed: {', '.join(available_backends())})")
+    BACKEND = name
+    if name == "msgspec":
+        loads = msgspec.json.decode
+        dumps = _ENCODER.encode
+        decode_parent_page = _msgspec_parent
+        decode_child_page = _msgspec_child
+        return
+    loads = orjson.loads if name == "orjson" else _json_loads
+    dumps = _orjson_dumps if name == "orjson" else _json_dumps
+    decode_parent_page = _generic_parent
+    decode_child_page = _generic_child
+
+BACKEND = ""
+use(os.environ.get(BACKEND_ENV) or available_backends()[0])
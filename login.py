@@ -3,15 +3,18 @@
 
 import argparse
 import json
+import os
+import tempfile
 import time
 import hmac
 import hashlib
 import uuid
 import random
 import sys
-from typing import Optional, Dict, Any, Tuple
+from http.cookiejar import Cookie, CookieJar, DefaultCookiePolicy
+from typing import Optional, Dict, Any, Iterable, Tuple
 
-import requests
+import httpx
 
 API_URL = "https://i.instagram.com/api/{version}/"
 V = "v1"
@@ -23,6 +26,10 @@ APPLICATION_ID = "567067343352427"
 FB_HTTP_ENGINE = "Liger"
 
 COOKIE_JSON_PATH = "cookie.json"
+LOGIN_COOKIES = ("sessionid", "csrftoken", "mid", "ds_user_id")
+FORM_HEADERS = {"Content-type": "application/x-www-form-urlencoded; charset=UTF-8"}
+PRELOGIN_URL = API_URL.format(version=V) + "si/fetch_headers/"
+LOGIN_URL = API_URL.format(version=V) + "accounts/login/"
 
 # ---------- Utilities ----------
 
@@ -48,7 +55,6 @@ def generate_adid(seed: Optional[str] = None, username: Optional[str] = None, ds
 def default_headers(useragent: str, igcap: str, appid: str) -> Dict[str, str]:
     return {
         "User-Agent": useragent,
-        "Connection": "close",
         "Accept": "*/*",
         "Accept-Language": "en-US",
         "Accept-Encoding": "gzip, deflate",
@@ -70,24 +76,39 @@ def sign_params(signature_key: str, key_version: str, params: dict) -> Dict[str,
         "signed_body": f"{mac}.{json_params}",
     }
 
-def get_cookie_value(jar: requests.cookies.RequestsCookieJar, key: str, domain: str = "instagram.com") -> Optional[str]:
+def cookie_values(jar: Iterable[Cookie], keys: Iterable[str] = LOGIN_COOKIES,
+                  domain: str = "instagram.com") -> Dict[str, Tuple[str, Optional[int]]]:
+    """
+    {name: (value, expires)} for each of `keys` in a single pass over `jar`,
+    preferring the latest-expiring live cookie for the domain.
+    """
     now = int(time.time())
     eternity = now + 100 * 365 * 24 * 60 * 60
-    # Prefer latest-expiring cookie for the domain
-    for c in sorted(jar, key=lambda c: c.expires or eternity, reverse=True):
-        if c.expires and c.expires < now:
+    wanted = {k.lower(): k for k in keys}
+    found: Dict[str, Tuple[str, Optional[int]]] = {}
+    best: Dict[str, int] = {}
+    for c in jar:
+        key = wanted.get(c.name.lower())
+        if key is None or (c.expires and c.expires < now):
             continue
         cookiedomain = c.domain[1:] if c.domain.startswith(".") else c.domain
         if not domain.endswith(cookiedomain):
             continue
-        if c.name.lower() == key.lower():
-            return c.value
-    return None
+        expires = c.expires or eternity
+        if key not in best or expires > best[key]:
+            best[key] = expires
+            found[key] = (c.value, c.expires)
+    return found
+
+def get_cookie_value(jar: Iterable[Cookie], key: str, domain: str = "instagram.com") -> Optional[str]:
+    hit = cookie_values(jar, (key,), domain).get(key)
+    return hit[0] if hit else None
 
 # ---------- Cookie JSON Helpers ----------
 
 def write_cookie_json(sessionid: str, csrftoken: str, mid: str, ds_user_id: str,
-                      per_cookie_expiry: Optional[Dict[str, Optional[int]]] = None) -> None:
+                      per_cookie_expiry: Optional[Dict[str, Optional[int]]] = None,
+                      path: Optional[str] = None) -> None:
     now = int(time.time())
     per_cookie_expiry = per_cookie_expiry or {}
 
@@ -115,12 +136,27 @@ def write_cookie_json(sessionid: str, csrftoken: str, mid: str, ds_user_id: str,
             "ds_user_id": per_cookie_expiry.get("ds_user_id")
         }
     }
-    with open(COOKIE_JSON_PATH, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
-
-def read_cookie_json() -> Optional[Dict[str, Any]]:
+    # Write a private temp file next to the target and rename it over, so
+    # concurrent refreshes and readers only ever see a complete file.
+    path = path or COOKIE_JSON_PATH
+    fd, tmp = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp",
+                               dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+
+def read_cookie_json(path: Optional[str] = None) -> Optional[Dict[str, Any]]:
     try:
-        with open(COOKIE_JSON_PATH, "r", encoding="utf-8") as f:
+        with open(path or COOKIE_JSON_PATH, "r", encoding="utf-8") as f:
             return json.load(f)
     except Exception:
         return None
@@ -139,28 +175,33 @@ def cookie_json_valid(d: Optional[Dict[str, Any]]) -> bool:
 class LoginError(Exception):
     pass
 
-def login_instagram(username: str, password: str, timeout_prelogin: int = 10, timeout_login: int = 20) -> Tuple[str, str, str, str]:
+def login_client_options(max_connections: int = 10) -> Dict[str, Any]:
     """
-    Perform the mobile-app-like login and return tuple:
-    (sessionid, csrftoken, mid, ds_user_id)
-    Raises LoginError on failure with meaningful message.
+    Shared settings for login clients: keep-alive pooling and app headers, but no
+    cookie storage, so concurrent logins of different accounts over one client
+    never see each other's cookies (each login reads its own responses').
     """
-    s = requests.Session()
-    s.headers.update(default_headers(USER_AGENT, IG_CAPABILITIES, APPLICATION_ID))
+    return {
+        "http2": True,
+        "headers": default_headers(USER_AGENT, IG_CAPABILITIES, APPLICATION_ID),
+        "cookies": CookieJar(policy=DefaultCookiePolicy(allowed_domains=[])),
+        "limits": httpx.Limits(max_keepalive_connections=max_connections, max_connections=max_connections),
+        "timeout": httpx.Timeout(20.0, connect=10.0),
+    }
 
-    # Pre-login to fetch CSRF
-    guid = generate_uuid(True)
-    prelogin_url = API_URL.format(version=V) + "si/fetch_headers/"
-    prelogin_query = {"challenge_type": "signup", "guid": generate_uuid(True)}
-    try:
-        r = s.post(prelogin_url, params=prelogin_query, headers={"Content-type": "application/x-www-form-urlencoded; charset=UTF-8"}, timeout=timeout_prelogin)
-    except requests.RequestException as e:
-        raise LoginError(f"Network error during prelogin: {e}")
+def make_login_client(max_connections: int = 10) -> httpx.AsyncClient:
+    return httpx.AsyncClient(**login_client_options(max_connections))
+
+def prelogin_params() -> Dict[str, str]:
+    return {"challenge_type": "signup", "guid": generate_uuid(True)}
 
-    csrftoken = get_cookie_value(s.cookies, "csrftoken")
+def prelogin_csrftoken(r: httpx.Response) -> str:
+    csrftoken = get_cookie_value(r.cookies.jar, "csrftoken")
     if not csrftoken:
         raise LoginError("Unable to get CSRF from prelogin.")
+    return csrftoken
 
+def login_form(username: str, password: str, csrftoken: str) -> Dict[str, str]:
     device_id = generate_device_id()
     login_params = {
         "device_id": device_id,
@@ -172,14 +213,14 @@ def login_instagram(username: str, password: str, timeout_prelogin: int = 10, ti
         "password": password,
         "login_attempt_count": 0,
     }
-    signed = sign_params(IG_SIG_KEY, SIG_KEY_VERSION, login_params)
-    login_url = API_URL.format(version=V) + "accounts/login/"
+    return sign_params(IG_SIG_KEY, SIG_KEY_VERSION, login_params)
 
-    try:
-        r = s.post(login_url, data=signed, headers={"Content-type": "application/x-www-form-urlencoded; charset=UTF-8"}, timeout=timeout_login)
-    except requests.RequestException as e:
-        raise LoginError(f"Network error during login: {e}")
+def login_headers(prelogin: httpx.Response) -> Dict[str, str]:
+    """Form headers plus the prelogin cookies, which a cookie-less client does not resend by itself."""
+    cookies = "; ".join(f"{c.name}={c.value}" for c in prelogin.cookies.jar)
+    return {**FORM_HEADERS, "Cookie": cookies} if cookies else dict(FORM_HEADERS)
 
+def login_result(r: httpx.Response, prelogin: httpx.Response) -> Tuple[str, str, str, str]:
     # Attempt JSON parse, but tolerate non-JSON
     try:
         j = r.json()
@@ -202,16 +243,59 @@ def login_instagram(username: str, password: str, timeout_prelogin: int = 10, ti
     if not j.get("logged_in_user", {}).get("pk"):
         raise LoginError(f"Unable to login: {j}")
 
-    # Extract cookies
-    sessionid = get_cookie_value(s.cookies, "sessionid", domain="instagram.com")
-    csrftoken = get_cookie_value(s.cookies, "csrftoken", domain="instagram.com")
-    mid = get_cookie_value(s.cookies, "mid", domain="instagram.com")
-    dsuserid = get_cookie_value(s.cookies, "ds_user_id", domain="instagram.com")
+    # Extract cookies: the login response's first, then whatever the prelogin set (e.g. mid)
+    found = cookie_values(list(r.cookies.jar) + list(prelogin.cookies.jar), LOGIN_COOKIES, domain="instagram.com")
+    cookies = tuple(found.get(k, ("", None))[0] for k in LOGIN_COOKIES)
 
-    if not all([sessionid, csrftoken, mid, dsuserid]):
+    if not all(cookies):
         raise LoginError("Login succeeded but required cookies are missing.")
 
-    return (sessionid, csrftoken, mid, dsuserid)
+    return cookies
+
+async def login_instagram_async(username: str, password: str, client: Optional[httpx.AsyncClient] = None,
+                                timeout_prelogin: int = 10, timeout_login: int = 20) -> Tuple[str, str, str, str]:
+    """
+    login_instagram() on an async client, so logins do not block the event loop.
+    Pass a shared make_login_client() to reuse its kept-alive connections across logins.
+    """
+    if client is None:
+        async with make_login_client() as own_client:
+            return await login_instagram_async(username, password, own_client, timeout_prelogin, timeout_login)
+
+    # Pre-login to fetch CSRF
+    try:
+        pre = await client.post(PRELOGIN_URL, params=prelogin_params(), headers=FORM_HEADERS, timeout=timeout_prelogin)
+    except httpx.HTTPError as e:
+        raise LoginError(f"Network error during prelogin: {e}")
+    csrftoken = prelogin_csrftoken(pre)
+
+    try:
+        r = await client.post(LOGIN_URL, data=login_form(username, password, csrftoken), headers=login_headers(pre),
+                              timeout=timeout_login)
+    except httpx.HTTPError as e:
+        raise LoginError(f"Network error during login: {e}")
+    return login_result(r, pre)
+
+def login_instagram(username: str, password: str, timeout_prelogin: int = 10, timeout_login: int = 20) -> Tuple[str, str, str, str]:
+    """
+    Perform the mobile-app-like login and return tuple:
+    (sessionid, csrftoken, mid, ds_user_id)
+    Raises LoginError on failure with meaningful message.
+    """
+    with httpx.Client(**login_client_options(max_connections=1)) as client:
+        # Pre-login to fetch CSRF; the login POST reuses the same connection.
+        try:
+            pre = client.post(PRELOGIN_URL, params=prelogin_params(), headers=FORM_HEADERS, timeout=timeout_prelogin)
+        except httpx.HTTPError as e:
+            raise LoginError(f"Network error during prelogin: {e}")
+        csrftoken = prelogin_csrftoken(pre)
+
+        try:
+            r = client.post(LOGIN_URL, data=login_form(username, password, csrftoken), headers=login_headers(pre),
+                            timeout=timeout_login)
+        except httpx.HTTPError as e:
+            raise LoginError(f"Network error during login: {e}")
+        return login_result(r, pre)
 
 # ---------- CLI ----------
 
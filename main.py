@@ -1,17 +1,41 @@
 # -*- coding: utf-8 -*-
 
+import argparse
 import asyncio
+import csv
 import httpx
 import json
 import os
+import random
 import re
 import sys
 import time
+from email.utils import parsedate_to_datetime
+from collections import deque
 from math import ceil
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, AsyncIterator, Callable, Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple
 from datetime import datetime
 from tqdm import tqdm
 
+import codec
+import shards
+from cache import DEFAULT_CACHE_MB, DEFAULT_CACHE_PATH, DEFAULT_CACHE_TTL, CacheEntry, ResponseCache, cache_key
+from metrics import METRICS, DEFAULT_STATS_INTERVAL, StatsFile, serve_prometheus
+from session import (
+    CredentialCache,
+    CredentialSource,
+    Session,
+    SessionPool,
+    credential_source,
+    load_accounts,
+    load_session_pool,
+    USERNAME_ENV,
+    PASSWORD_ENV,
+)
+from sinks import (
+    DEFAULT_FORMATS, FILE_SINKS, OUTPUT_DIR, ListSink, MultiSink, QueueSink, Sink, missing_dependencies, output_dir,
+    output_path, read_ndjson, set_output_dir,
+)
 from login import (
     login_instagram,
     read_cookie_json,
@@ -20,208 +44,1056 @@ from login import (
     LoginError,
 )
 
+BASE_URL = "https://www.instagram.com"
+GRAPHQL_PATH = "/graphql/query/"
+GRAPHQL_URL = BASE_URL + GRAPHQL_PATH
 PARENT_QUERY_HASH = "97b41c52301f77ce508f55e66d17620e"
+CHILD_QUERY_HASH = "1ee91c32fc020d44158a3192eda98247"
+CHECKPOINT_DIR = "checkpoints"  # under the output directory
+INDEX_DIR = "index"
 COMMENTS_PER_PAGE = 50
+REPLIES_PER_PAGE = 50
+DEFAULT_REPLY_WORKERS = 4
+PREFETCH_PAGES = 4
+PROBE_PAGE_SIZE = 1
+PROBE_FILE = os.path.join("download_comments", "probes.csv")
+DEFAULT_RPS = 5.0
+DEFAULT_COOKIE_DIR = "cookies"
+DEFAULT_CONCURRENCY = 4
+MAX_TRIES = 5
+BACKOFF_BASE = 1.0
+BACKOFF_CAP = 60.0
+MIN_RPS = 0.1
+QUERY_NAMES = {PARENT_QUERY_HASH: "parent", CHILD_QUERY_HASH: "child"}
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+SHORTCODE_RE = re.compile(r"[A-Za-z0-9_-]+")
+DURATION_RE = re.compile(r"(\d+(?:\.\d+)?)\s*([smhdw])")
+DURATION_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 7 * 86400}
 
 class ScrapeError(Exception):
-    pass
+    def __init__(self, message: str, status: Optional[int] = None, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+def is_auth_error(e: ScrapeError) -> bool:
+    return e.status == 401 or e.status in REDIRECT_STATUSES
+
+def is_throttle_error(e: ScrapeError) -> bool:
+    return e.status == 429 or (e.status is not None and e.status >= 500)
+
+def retry_reason(e: ScrapeError) -> str:
+    return "throttled" if e.status == 429 else "server_error"
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Retry-After is either delta-seconds or an HTTP date."""
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def backoff_delay(attempt: int, retry_after: Optional[float] = None) -> float:
+    """Exponential backoff with jitter; a server-provided Retry-After wins."""
+    if retry_after is not None:
+        return retry_after + random.uniform(0, 0.25)
+    return min(BACKOFF_CAP, BACKOFF_BASE * 2 ** (attempt - 1)) * random.uniform(0.5, 1.0)
 
 def extract_shortcode(url: str) -> Optional[str]:
     m = re.search(r"instagram\.com/(?:reel|p)/([^/?#]+)/?", url)
     return m.group(1) if m else None
 
-def cookies_string(sessionid: str, csrftoken: str, mid: str, dsuserid: str) -> str:
-    return f"sessionid={sessionid}; ds_user_id={dsuserid}; csrftoken={csrftoken}; mid={mid}"
-
-def build_headers(shortcode: str, cookies_str: str) -> Dict[str, str]:
-    return {
-        "User-Agent": "Mozilla/5.0 (Linux; Android 13; SM-A125F) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Mobile Safari/537.36",
-        "Accept": "*/*",
-        "Accept-Language": "en-US,en;q=0.9",
-        "X-Requested-With": "XMLHttpRequest",
-        "X-IG-App-ID": "936619743392459",
-        "Referer": f"https://www.instagram.com/reel/{shortcode}/",
-        "Cookie": cookies_str,
-    }
-
-async def graphql_request(client: httpx.AsyncClient, query_hash: str, variables: Dict[str, Any]) -> Dict[str, Any]:
+def read_shortcodes(path: str) -> List[str]:
+    """
+    Read reel URLs or bare shortcodes, one per line, from a file or stdin ('-').
+    Blank lines and '#' comments are skipped; duplicates are dropped in order.
+    """
+    f = sys.stdin if path == "-" else open(path, "r", encoding="utf-8")
+    try:
+        lines = f.read().splitlines()
+    finally:
+        if f is not sys.stdin:
+            f.close()
+    return parse_shortcodes(lines)
+
+def parse_shortcodes(lines: Iterable[str]) -> List[str]:
+    """Shortcodes from reel URLs or bare shortcodes; see read_shortcodes()."""
+    shortcodes: List[str] = []
+    seen = set()
+    for raw in lines:
+        line = raw.strip()
+        if not line or line.startswith("#"):
+            continue
+        sc = extract_shortcode(line) or (line if SHORTCODE_RE.fullmatch(line) else None)
+        if not sc:
+            print(f"! Skipping invalid entry: {line}")
+            continue
+        if sc not in seen:
+            seen.add(sc)
+            shortcodes.append(sc)
+    return shortcodes
+
+def make_client(max_connections: int = 20, base_url: Optional[str] = None) -> httpx.AsyncClient:
+    """Pooled HTTP/2 client; `base_url` points it at another host (e.g. the bench.py stand-in server)."""
+    limits = httpx.Limits(max_keepalive_connections=max(10, max_connections // 2), max_connections=max_connections)
+    return httpx.AsyncClient(http2=True, timeout=httpx.Timeout(20.0, connect=10.0), limits=limits,
+                             base_url=base_url or BASE_URL)
+
+def decode_response(body: bytes, query_hash: str, decode=None) -> Any:
+    try:
+        with METRICS.timer("instascrape_decode_seconds", query=QUERY_NAMES.get(query_hash, "other")):
+            return (decode or codec.loads)(body)
+    except codec.ShapeError as e:
+        raise ScrapeError(f"Unexpected GraphQL shape; {e}.")
+    except Exception:
+        raise ScrapeError("Failed to parse JSON from GraphQL response.")
+
+async def graphql_request(client: httpx.AsyncClient, query_hash: str, variables: Dict[str, Any],
+                          headers: Optional[Dict[str, str]] = None, decode=None,
+                          cache: Optional[ResponseCache] = None, cached: Optional[CacheEntry] = None) -> Any:
+    """
+    One GraphQL GET; the body goes through `decode` (a codec decoder, plain
+    codec.loads by default). With a cache, good responses are stored in it, and
+    an expired `cached` entry is revalidated with If-None-Match/If-Modified-Since.
+    """
     var_str = json.dumps(variables, separators=(",", ":"))
-    url = "https://www.instagram.com/graphql/query/"
     params = {"query_hash": query_hash, "variables": var_str}
-    r = await client.get(url, params=params, follow_redirects=False, timeout=20)
-    if r.status_code in (301, 302, 303, 307, 308):
-        raise ScrapeError("Redirected (possible auth required).")
+    if cached is not None:
+        headers = {**(headers or {}), **cached.validators()}
+    # Headers are passed per request so one pooled client can serve many reels at once.
+    # Clients from make_client() carry a base_url; fall back to Instagram for any other client.
+    url = GRAPHQL_PATH if client.base_url.host else GRAPHQL_URL
+    query = QUERY_NAMES.get(query_hash, "other")
+    started = time.perf_counter()
+    r = await client.get(url, params=params, headers=headers, follow_redirects=False, timeout=20)
+    METRICS.observe("instascrape_request_seconds", time.perf_counter() - started, query=query)
+    METRICS.inc("instascrape_requests_total", query=query, status=str(r.status_code))
+    METRICS.inc("instascrape_response_bytes_total", len(r.content), query=query)
+    if r.status_code == 304 and cached is not None:
+        METRICS.inc("instascrape_cache_total", result="revalidated")
+        result = decode_response(cached.body, query_hash, decode)
+        cache.refresh(cache_key(query_hash, variables))
+        return result
+    if r.status_code in REDIRECT_STATUSES:
+        raise ScrapeError("Redirected (possible auth required).", status=r.status_code)
     if r.status_code == 401:
-        raise ScrapeError("Unauthorized (401).")
+        raise ScrapeError("Unauthorized (401).", status=401)
+    if r.status_code == 429:
+        raise ScrapeError("Rate limited (429).", status=429, retry_after=parse_retry_after(r.headers.get("Retry-After")))
     if r.status_code != 200:
         text = r.text[:200] if r.text else f"HTTP {r.status_code}"
-        raise ScrapeError(f"HTTP {r.status_code}: {text}")
-    try:
-        return r.json()
-    except Exception:
-        raise ScrapeError("Failed to parse JSON from GraphQL response.")
+        raise ScrapeError(f"HTTP {r.status_code}: {text}", status=r.status_code,
+                          retry_after=parse_retry_after(r.headers.get("Retry-After")))
+    result = decode_response(r.content, query_hash, decode)
+    if cache is not None:
+        # Only bodies that decoded cleanly are cached.
+        METRICS.inc("instascrape_cache_total", result="miss")
+        cache.put(cache_key(query_hash, variables), r.content, r.headers.get("ETag"), r.headers.get("Last-Modified"))
+    return result
+
+def open_outputs(base_name: str, formats: Sequence[str] = DEFAULT_FORMATS,
+                 checkpoint: Optional["Checkpoint"] = None, fresh: bool = False, shortcode: str = "") -> MultiSink:
+    """
+    Open the streaming export files for one reel. If the checkpoint holds a
+    previous run's state, that run's partial files are reopened instead and
+    `base_name`/`formats` are ignored; with `fresh` they are deleted.
+    """
+    state = checkpoint.load() if checkpoint else None
+    if state and state.get("sink"):
+        try:
+            previous = MultiSink.restore(state["sink"])
+            if not fresh:
+                return previous
+            previous.abort()
+        except (OSError, KeyError, ValueError):
+            if not fresh:
+                tqdm.write(f"! Checkpoint for {checkpoint.shortcode} has no usable partial output; starting over.")
+        checkpoint.clear()
+    return MultiSink(base_name, formats, shortcode)
+
+def print_saved(count: int, paths: List[str]):
+    print(f"Saved {count} comments:")
+    for path in paths:
+        print(f" - {path}")
+
+class Checkpoint:
+    """
+    Durable pagination state for one shortcode.
+
+    The comments themselves live in the sink's partial export files; each commit
+    fsyncs those first and then replaces <shortcode>.json (via .tmp + os.replace)
+    with the cursor and the byte offsets reached, so the state never points past
+    data that reached the disk. Bytes after the committed offsets (a page torn by
+    a crash) are truncated when the sink is restored.
+    """
+
+    def __init__(self, shortcode: str, directory: Optional[str] = None):
+        self.shortcode = shortcode
+        self.state_path = os.path.join(directory or output_dir(CHECKPOINT_DIR), f"{shortcode}.json")
+        self.state: Optional[Dict[str, Any]] = None
+
+    def load(self) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self.state_path, "r", encoding="utf-8") as f:
+                state = json.load(f)
+        except Exception:
+            return None
+        if not isinstance(state, dict) or state.get("shortcode") != self.shortcode:
+            return None
+        self.state = state
+        return state
+
+    def commit(self, sink: Sink, end_cursor: Optional[str], has_next: bool, total_count: int):
+        sink.sync()
+        state = {
+            "shortcode": self.shortcode,
+            "end_cursor": end_cursor,
+            "has_next": bool(has_next),
+            "total_count": total_count,
+            "count": sink.count,
+            "sink": sink.state(),
+            "updated_at": int(time.time()),
+        }
+        os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+        tmp = self.state_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.state_path)
+        self.state = state
+
+    def clear(self):
+        self.state = None
+        try:
+            os.remove(self.state_path)
+        except FileNotFoundError:
+            pass
+
+class SeenIndex:
+    """
+    Comment IDs already exported for one shortcode, plus the newest created_at.
+    Incremental runs use it to keep only unseen comments and to stop paginating
+    at the first page that holds nothing new.
+    Under a --match/--user filter, the IDs the filter dropped are kept as
+    `examined` together with the filter's signature, so the next run with the
+    same filter can still stop early while an unfiltered run fetches them again.
+    """
+
+    def __init__(self, shortcode: str, directory: Optional[str] = None):
+        self.shortcode = shortcode
+        self.path = os.path.join(directory or output_dir(INDEX_DIR), f"{shortcode}.json")
+        self.ids = set()
+        self.examined = set()
+        self.filter_signature: Optional[str] = None
+        self.newest_created_at: Optional[int] = None
+
+    def load(self) -> bool:
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                d = json.load(f)
+        except Exception:
+            return False
+        if not isinstance(d, dict) or d.get("shortcode") != self.shortcode:
+            return False
+        self.ids = set(d.get("ids") or [])
+        self.examined = set(d.get("examined") or [])
+        self.filter_signature = d.get("filter")
+        self.newest_created_at = d.get("newest_created_at")
+        return True
+
+    def older_than(self, path: str) -> bool:
+        """Whether the saved index was written before the file at `path` last changed."""
+        try:
+            return os.stat(self.path).st_mtime_ns < os.stat(path).st_mtime_ns
+        except OSError:
+            return False
+
+    def reset(self):
+        self.ids = set()
+        self.examined = set()
+        self.newest_created_at = None
 
-def parse_parent_comments(data: Dict[str, Any]) -> Tuple[List[str], Dict[str, Any], List[Dict[str, Any]]]:
+    def use_filter(self, signature: Optional[str]):
+        """Start a run under the filter with this signature; examined IDs from another filter no longer count."""
+        if signature != self.filter_signature:
+            self.examined = set()
+            self.filter_signature = signature
+
+    def known(self, comments: List[Dict[str, Any]]) -> bool:
+        """Whether a non-empty page is made up entirely of comments exported or examined before."""
+        return bool(comments) and all(c.get("id") is not None and (c.get("id") in self.ids or c.get("id") in self.examined)
+                                      for c in comments)
+
+    def examine(self, comments: List[Dict[str, Any]]):
+        """Remember the IDs of a fetched page that the current filter did not export."""
+        if self.filter_signature is not None:
+            self.examined.update(c.get("id") for c in comments if c.get("id") is not None and c.get("id") not in self.ids)
+
+    def add_new(self, comments: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Record and return the comments not seen before. Comments without an id always count as new."""
+        new: List[Dict[str, Any]] = []
+        for c in comments:
+            cid = c.get("id")
+            if cid is not None:
+                if cid in self.ids:
+                    continue
+                self.ids.add(cid)
+            created_at = c.get("created_at")
+            if isinstance(created_at, int) and (self.newest_created_at is None or created_at > self.newest_created_at):
+                self.newest_created_at = created_at
+            new.append(c)
+        return new
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        data = {
+            "shortcode": self.shortcode,
+            "updated_at": int(time.time()),
+            "newest_created_at": self.newest_created_at,
+            "count": len(self.ids),
+            "ids": sorted(self.ids),
+            "filter": self.filter_signature,
+            "examined": sorted(self.examined - self.ids),
+        }
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f, separators=(",", ":"))
+        os.replace(tmp, self.path)
+
+class CommentFilter:
+    """
+    Predicates applied to each parent comment page as it arrives: created_at at
+    or after `since` (Unix seconds), text matching `pattern` (a regex, case-
+    insensitive) and author among `usernames`. A comment must pass all of the
+    given ones. Pages come newest first, so once a page reaches past `since`
+    nothing later can match and pagination stops.
+    """
+
+    def __init__(self, since: Optional[int] = None, pattern: Optional[str] = None,
+                 usernames: Optional[Iterable[str]] = None):
+        self.since = since
+        self.pattern = re.compile(pattern, re.IGNORECASE) if pattern else None
+        self.usernames = {u.lower().lstrip("@") for u in usernames} if usernames else None
+
+    def matches(self, c: Any) -> bool:
+        if self.since is not None:
+            created_at = c.get("created_at")
+            if not isinstance(created_at, (int, float)) or created_at < self.since:
+                return False
+        if self.usernames is not None and (c.get("username") or "").lower() not in self.usernames:
+            return False
+        return self.pattern is None or bool(self.pattern.search(c.get("text") or ""))
+
+    def apply(self, comments: List[Any]) -> List[Any]:
+        return [c for c in comments if self.matches(c)]
+
+    def signature(self) -> Optional[str]:
+        """Identifies the --match/--user predicates (not `since`, which moves every run); None without them."""
+        if self.pattern is None and self.usernames is None:
+            return None
+        return json.dumps({"match": self.pattern.pattern if self.pattern else None,
+                           "users": sorted(self.usernames) if self.usernames else None}, separators=(",", ":"))
+
+    def exhausted(self, comments: List[Any]) -> bool:
+        """
+        True when the page reaches past `since`. Its last comment is the oldest,
+        so a pinned old comment at the top of the first page does not count.
+        """
+        if self.since is None or not comments:
+            return False
+        created_at = comments[-1].get("created_at")
+        return isinstance(created_at, (int, float)) and created_at < self.since
+
+def parse_since(value: str) -> int:
+    """--since: a Unix timestamp, an ISO date/datetime (local time unless it has an offset) or an age like 24h / 7d."""
+    value = value.strip()
+    m = DURATION_RE.fullmatch(value.lower())
+    if m:
+        return int(time.time() - float(m.group(1)) * DURATION_UNITS[m.group(2)])
+    if value.isdigit():
+        return int(value)
     try:
-        media = data["data"]["shortcode_media"]
-        edge_info = media["edge_media_to_parent_comment"]
-        edges = edge_info["edges"]
-        page_info = edge_info["page_info"]
-    except KeyError:
-        raise ScrapeError("Unexpected GraphQL shape; missing comment edges.")
-    flat: List[str] = []
-    struct: List[Dict[str, Any]] = []
-    for edge in edges:
-        node = edge.get("node", {})
-        text = node.get("text", "")
-        user = node.get("owner", {}).get("username", "")
-        created_at = node.get("created_at")
-        flat.append(f"{user}: {text}")
-        struct.append({"username": user, "text": text, "created_at": created_at})
-    return flat, page_info, struct
-
-def get_counts_from_first_page(data: dict) -> int:
+        return int(datetime.fromisoformat(value).timestamp())
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected a Unix timestamp, an ISO date like 2024-05-01 or an age like 24h, 7d")
+
+def parse_regex(value: str) -> str:
     try:
-        media = data["data"]["shortcode_media"]
-        count = media["edge_media_to_parent_comment"].get("count")
-        if isinstance(count, int) and count >= 0:
-            return count
-    except Exception:
-        pass
-    return 0
+        re.compile(value)
+    except re.error as e:
+        raise argparse.ArgumentTypeError(f"invalid regex: {e}")
+    return value
 
-def ensure_output_dirs():
-    os.makedirs("download_comments/txt", exist_ok=True)
-    os.makedirs("download_comments/json", exist_ok=True)
-
-def write_outputs(base_name: str, comments_flat: List[str], comments_struct: List[Dict[str, Any]]):
-    ensure_output_dirs()
-    txt_path = os.path.join("download_comments", "txt", f"{base_name}.txt")
-    json_path = os.path.join("download_comments", "json", f"{base_name}.json")
-
-    tmp_txt = txt_path + ".tmp"
-    with open(tmp_txt, "w", encoding="utf-8") as f:
-        f.write("\n".join(comments_flat))
-    os.replace(tmp_txt, txt_path)
-
-    tmp_json = json_path + ".tmp"
-    payload = {
-        "generated_at": int(time.time()),
-        "count": len(comments_struct),
-        "comments": comments_struct,
-    }
-    with open(tmp_json, "w", encoding="utf-8") as f:
-        json.dump(payload, f, ensure_ascii=False, indent=2)
-    os.replace(tmp_json, json_path)
-
-    print(f"Saved {len(comments_struct)} comments:")
-    print(f" - {txt_path}")
-    print(f" - {json_path}")
-
-async def refresh_cookies_interactive(shortcode: str) -> Tuple[str, str, str, str, Dict[str, str]]:
-    print("Detected expired/invalid cookies. Please relogin.")
-    username = input("Enter your username: ").strip()
-    password = input("Enter your instagram password: ").strip()
-    si, ct, m, du = login_instagram(username, password)
-    write_cookie_json(si, ct, m, du)
-    headers = build_headers(shortcode, cookies_string(si, ct, m, du))
-    print("Refreshed cookies saved.")
-    return si, ct, m, du, headers
-
-def headers_from_store(shortcode: str, fallback: Tuple[str, str, str, str]) -> Dict[str, str]:
-    dj = read_cookie_json()
-    if cookie_json_valid(dj):
-        c = dj["cookies"]
-        ck = cookies_string(c["sessionid"], c["csrftoken"], c["mid"], c["ds_user_id"])
-    else:
-        ck = cookies_string(*fallback)
-    return build_headers(shortcode, ck)
+class ScrapeOptions(NamedTuple):
+    """
+    Settings shared by every reel of a run: the account pool (a single
+    cookie.json session when None), reply-thread workers, the host to scrape
+    (Instagram when None), a response cache and a comment filter.
+    """
+    pool: Optional[SessionPool] = None
+    reply_workers: int = 0
+    base_url: Optional[str] = None
+    cache: Optional[ResponseCache] = None
+    comment_filter: Optional[CommentFilter] = None
+
+DEFAULT_OPTIONS = ScrapeOptions()
 
 class RateLimiter:
     def __init__(self, rps: float):
-        self.rps = max(0.1, float(rps))
+        self.rps = max(MIN_RPS, float(rps))
         self.interval = 1.0 / self.rps
         self._last = 0.0
         self._lock = asyncio.Lock()
+        self.requests = 0
+        self.throttled = 0
+        self.errors = 0
+        self._first: Optional[float] = None
+
+    def _next_slot(self) -> float:
+        return self._last + self.interval
 
     async def wait(self):
+        started = time.perf_counter()
         async with self._lock:
-            now = time.perf_counter()
-            delta = now - self._last
-            if delta < self.interval:
-                await asyncio.sleep(self.interval - delta)
+            delay = self._next_slot() - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
             self._last = time.perf_counter()
+            if self._first is None:
+                self._first = self._last
+            self.requests += 1
+        METRICS.observe("instascrape_limiter_wait_seconds", self._last - started)
+
+    # Feedback hooks, called by limited_request(); the fixed-rate limiter only counts them.
+    def on_success(self, latency: float):
+        pass
+
+    def on_throttle(self, retry_after: Optional[float] = None):
+        self.throttled += 1
+
+    def on_error(self):
+        self.errors += 1
 
-async def fetch_all_pages(shortcode: str, session_tuple: Tuple[str, str, str, str], rps: float) -> Tuple[List[str], List[Dict[str, Any]]]:
-    limits = httpx.Limits(max_keepalive_connections=10, max_connections=20)
-    async with httpx.AsyncClient(http2=True, timeout=httpx.Timeout(20.0, connect=10.0), limits=limits) as client:
-        headers = headers_from_store(shortcode, session_tuple)
-        client.headers.update(headers)
+    def effective_rps(self) -> float:
+        if self._first is None or self.requests < 2 or self._last <= self._first:
+            return 0.0
+        return (self.requests - 1) / (self._last - self._first)
 
-        variables = {"shortcode": shortcode, "first": COMMENTS_PER_PAGE}
+    def report(self) -> str:
+        return (f"{self.requests} requests at {self.effective_rps():.2f} req/s effective (fixed limit {self.rps:g} req/s), "
+                f"{self.throttled} throttled, {self.errors} errors")
+
+class AdaptiveRateLimiter(RateLimiter):
+    """
+    AIMD controller with `rps` as its ceiling. A 429 halves the rate and pauses
+    every caller for Retry-After (or a jittered exponential backoff); 5xx,
+    network errors and latency spikes cut it more gently. Healthy responses add
+    the rate back linearly, about `increase` req/s per second of traffic.
+    """
+
+    def __init__(self, rps: float, min_rps: float = MIN_RPS, increase: Optional[float] = None,
+                 latency_factor: float = 3.0):
+        super().__init__(rps)
+        self.max_rps = self.rps
+        self.min_rps = min(max(MIN_RPS, min_rps), self.max_rps)
+        self.increase = increase if increase is not None else max(0.05, self.max_rps / 20)
+        self.latency_factor = latency_factor
+        self._paused_until = 0.0
+        self._last_cut = 0.0
+        self._streak = 0
+        self._baseline: Optional[float] = None
+
+    def _next_slot(self) -> float:
+        return max(self._last + self.interval, self._paused_until)
+
+    def _set_rate(self, rps: float):
+        self.rps = min(self.max_rps, max(self.min_rps, rps))
+        self.interval = 1.0 / self.rps
+
+    def _cut(self, factor: float):
+        now = time.perf_counter()
+        # Several in-flight requests usually fail together; count that as one signal.
+        if now - self._last_cut < max(1.0, self.interval):
+            return
+        self._last_cut = now
+        self._set_rate(self.rps * factor)
+
+    def on_success(self, latency: float):
+        self._streak = 0
+        if self._baseline is None:
+            self._baseline = latency
+        spike = latency > self._baseline * self.latency_factor
+        # Spikes feed the average too: a lasting shift becomes the new baseline after a
+        # few samples instead of cutting the rate on every response from then on.
+        self._baseline = 0.9 * self._baseline + 0.1 * latency
+        if spike:
+            self._cut(0.9)
+            return
+        if time.perf_counter() >= self._paused_until:
+            self._set_rate(self.rps + self.increase * self.interval)
+
+    def on_throttle(self, retry_after: Optional[float] = None):
+        super().on_throttle(retry_after)
+        self._streak += 1
+        self._cut(0.5)
+        pause = backoff_delay(self._streak, retry_after)
+        self._paused_until = max(self._paused_until, time.perf_counter() + pause)
+
+    def on_error(self):
+        super().on_error()
+        self._cut(0.8)
+
+    def report(self) -> str:
+        return (f"{self.requests} requests at {self.effective_rps():.2f} req/s effective, "
+                f"settled at {self.rps:.2f} req/s (ceiling {self.max_rps:g}), "
+                f"{self.throttled} throttled, {self.errors} errors")
+
+def make_limiter(rps: float, adaptive: bool = True) -> RateLimiter:
+    return AdaptiveRateLimiter(rps) if adaptive else RateLimiter(rps)
+
+def single_session_pool(session_tuple: Tuple[str, str, str, str], limiter: RateLimiter,
+                        source: Optional[CredentialSource] = None) -> SessionPool:
+    """The default pool: one session over cookie.json (falling back to `session_tuple`) paced by `limiter`."""
+    return SessionPool([Session(CredentialCache(fallback=session_tuple), source, limiter=limiter)])
+
+async def limited_request(client: httpx.AsyncClient, limiter: RateLimiter, query_hash: str,
+                          variables: Dict[str, Any], headers: Optional[Dict[str, str]] = None,
+                          decode=None, max_tries: int = MAX_TRIES, cache: Optional[ResponseCache] = None):
+    """
+    One GraphQL request paced by `limiter`, decoded by `decode` (see graphql_request()).
+    429/5xx and network errors are retried with jittered exponential backoff
+    (honouring Retry-After) and reported to the limiter. Anything else (auth
+    failures, other 4xx, malformed responses) is raised at once: retrying would
+    not change the answer.
+    A fresh entry in `cache` is returned without waiting on the limiter.
+    """
+    cached = cache.get(cache_key(query_hash, variables)) if cache is not None else None
+    if cached is not None and cached.fresh:
+        METRICS.inc("instascrape_cache_total", result="hit")
+        return decode_response(cached.body, query_hash, decode)
+    attempt = 0
+    while True:
+        attempt += 1
+        await limiter.wait()
+        started = time.perf_counter()
         try:
-            data = await graphql_request(client, PARENT_QUERY_HASH, variables)
-        except ScrapeError:
-            si, ct, m, du, headers = await refresh_cookies_interactive(shortcode)
-            client.headers.update(headers)
-            data = await graphql_request(client, PARENT_QUERY_HASH, variables)
-
-        flat, page_info, struct = parse_parent_comments(data)
-        total_count = get_counts_from_first_page(data) or len(flat)
-        total_pages = max(1, ceil(total_count / COMMENTS_PER_PAGE))
-
-        all_flat: List[str] = list(flat)
-        all_struct: List[Dict[str, Any]] = list(struct)
-
-        has_next = page_info.get("has_next_page", False)
-        cursor = page_info.get("end_cursor")
-
-        limiter = RateLimiter(rps)
-        bar = tqdm(total=total_pages, desc="Fetching comments", unit="page", leave=True)
-        bar.update(1)
-
-        async def fetch_one(after_cursor: Optional[str]) -> Tuple[List[str], List[Dict[str, Any]], bool, Optional[str]]:
-            await limiter.wait()
-            dj = read_cookie_json()
-            hdrs = headers_from_store(shortcode, session_tuple) if cookie_json_valid(dj) else headers
-            client.headers.update(hdrs)
-            vars2 = {"shortcode": shortcode, "first": COMMENTS_PER_PAGE}
-            if after_cursor:
-                vars2["after"] = after_cursor
-
-            tries = 0
-            while True:
-                tries += 1
-                try:
-                    d2 = await graphql_request(client, PARENT_QUERY_HASH, vars2)
-                    f2, pinfo2, s2 = parse_parent_comments(d2)
-                    return f2, s2, pinfo2.get("has_next_page", False), pinfo2.get("end_cursor")
-                except ScrapeError as e:
-                    if "Unauthorized" in str(e) or "Redirected" in str(e):
-                        si, ct, m, du, hdrs2 = await refresh_cookies_interactive(shortcode)
-                        client.headers.update(hdrs2)
-                        continue
-                    if tries >= 3:
-                        raise
-                    await asyncio.sleep(1.0)
-
-        current_after = cursor
-        while has_next and current_after:
-            f2, s2, has_next, next_after = await fetch_one(current_after)
-            all_flat.extend(f2)
-            all_struct.extend(s2)
+            result = await graphql_request(client, query_hash, variables, headers, decode, cache, cached)
+        except ScrapeError as e:
+            if not is_throttle_error(e):
+                raise
+            if e.status == 429:
+                limiter.on_throttle(e.retry_after)
+            else:
+                limiter.on_error()
+            if attempt >= max_tries:
+                raise
+            METRICS.inc("instascrape_retries_total", reason=retry_reason(e))
+            await asyncio.sleep(backoff_delay(attempt, e.retry_after))
+            continue
+        except httpx.TransportError:
+            limiter.on_error()
+            if attempt >= max_tries:
+                raise
+            METRICS.inc("instascrape_retries_total", reason="network")
+            await asyncio.sleep(backoff_delay(attempt))
+            continue
+        limiter.on_success(time.perf_counter() - started)
+        return result
+
+async def pool_request(client: httpx.AsyncClient, pool: SessionPool, shortcode: str, query_hash: str,
+                       variables: Dict[str, Any], decode=None, cache: Optional[ResponseCache] = None) -> Any:
+    """
+    limited_request() on a session borrowed from `pool`. A session that fails
+    auth (401 or a redirect to login) is sent to log in again in the background
+    and the request is retried on another one. Any other error (a missing or
+    private reel, a malformed page) is raised for the caller: it fails the reel,
+    not the session.
+    """
+    while True:
+        sess = await pool.acquire()
+        generation = sess.generation
+        try:
+            try:
+                generation, hdrs = sess.headers(shortcode)
+            except LoginError:
+                sess.auth_failures += 1
+                pool.reauth(sess, generation)
+                continue
+            result = await limited_request(client, sess.limiter, query_hash, variables, hdrs, decode=decode,
+                                           cache=cache)
+            sess.succeeded(generation)
+            return result
+        except ScrapeError as e:
+            if not is_auth_error(e):
+                raise
+            sess.auth_failures += 1
+            pool.reauth(sess, generation)
+        finally:
+            pool.release(sess)
+
+class ReplyFetcher:
+    """
+    Bounded pool of workers paging through reply threads while parent-page
+    pagination carries on. `request(query_hash, variables, parse)` is the
+    caller's limiter- and auth-aware request function, so reply traffic shares
+    the same budget. The queue is bounded, so submit() blocks (and parent
+    pagination waits) when the workers fall behind.
+    """
+
+    def __init__(self, request, workers: int = DEFAULT_REPLY_WORKERS):
+        self._request = request
+        self.queue: "asyncio.Queue[Tuple[Dict[str, Any], Optional[str], asyncio.Future]]" = asyncio.Queue(maxsize=workers * 4)
+        self.requests = 0
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(max(1, workers))]
+
+    async def submit(self, parent: Dict[str, Any], after: Optional[str]) -> "asyncio.Future":
+        """Queue the rest of `parent`'s thread; replies are appended to parent["replies"]."""
+        fut = asyncio.get_running_loop().create_future()
+        await self.queue.put((parent, after, fut))
+        return fut
+
+    async def _worker(self):
+        while True:
+            parent, after, fut = await self.queue.get()
+            try:
+                while True:
+                    variables = {"comment_id": parent["id"], "first": REPLIES_PER_PAGE}
+                    if after:
+                        variables["after"] = after
+                    self.requests += 1
+                    page = await self._request(CHILD_QUERY_HASH, variables, codec.decode_child_page)
+                    parent["replies"].extend(page.comments)
+                    after = page.end_cursor
+                    if not (page.has_next and after):
+                        break
+                if not fut.done():
+                    fut.set_result(None)
+            except Exception as e:
+                if not fut.done():
+                    fut.set_exception(e)
+            finally:
+                self.queue.task_done()
+
+    async def close(self):
+        for t in self._tasks:
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+async def fetch_all_pages(shortcode: str, session_tuple: Tuple[str, str, str, str], rps: float,
+                          client: Optional[httpx.AsyncClient] = None,
+                          limiter: Optional[RateLimiter] = None,
+                          progress: bool = True,
+                          checkpoint: Optional[Checkpoint] = None,
+                          sink: Optional[Sink] = None,
+                          seen: Optional[SeenIndex] = None,
+                          options: ScrapeOptions = DEFAULT_OPTIONS) -> int:
+    """
+    Fetch every parent comment page of a reel into `sink` (a ListSink by
+    default) and return the number of comments it holds. Pages are handed to
+    the sink as they arrive, while a producer task fetches up to PREFETCH_PAGES
+    ahead. Without a pool in `options`, requests use one cookie.json session
+    (falling back to `session_tuple`, prompting for relogins) paced by `limiter`.
+    A loaded checkpoint resumes from its saved cursor and every page is committed
+    to it; finalizing the sink and clearing the checkpoint is left to the caller.
+    With a SeenIndex only unseen comments reach the sink, and pagination stops at
+    the first page made up entirely of known comments.
+    """
+    if client is None:
+        async with make_client(base_url=options.base_url) as own_client:
+            return await fetch_all_pages(shortcode, session_tuple, rps, client=own_client, limiter=limiter,
+                                         progress=progress, checkpoint=checkpoint, sink=sink, seen=seen,
+                                         options=options)
+
+    sink = sink if sink is not None else ListSink()
+    reply_workers, cache, comment_filter = options.reply_workers, options.cache, options.comment_filter
+    own_pool = options.pool is None
+    pool = options.pool or single_session_pool(session_tuple, limiter or AdaptiveRateLimiter(rps),
+                                               credential_source())
+
+    async def request(query_hash: str, variables: Dict[str, Any], decode=None):
+        return await pool_request(client, pool, shortcode, query_hash, variables, decode, cache)
+
+    def decode_page(raw: bytes) -> codec.ParentPage:
+        return codec.decode_parent_page(raw, threads=reply_workers > 0)
+
+    replies = ReplyFetcher(request, reply_workers) if reply_workers > 0 else None
+    # Pages waiting for their reply threads: (records, thread futures, end_cursor, has_next).
+    pending: "deque[Tuple[List[codec.Comment], List[asyncio.Future], Optional[str], bool]]" = deque()
+    total_count = 0
+
+    async def emit(records: List[codec.Comment], threads: codec.Threads, cursor: Optional[str], has_next: bool):
+        futures: List[asyncio.Future] = []
+        if replies is not None:
+            for rec in records:
+                thread = threads.get(rec.get("id"))
+                if thread is None:
+                    continue
+                inline, more, after = thread
+                rec["replies"] = inline
+                if more:
+                    futures.append(await replies.submit(rec, after))
+        pending.append((records, futures, cursor, has_next))
+        await flush(wait=False)
+
+    async def flush(wait: bool):
+        while pending:
+            records, futures, cursor, has_next = pending[0]
+            if futures:
+                if not wait and not all(f.done() for f in futures):
+                    return
+                await asyncio.gather(*futures)
+            pending.popleft()
+            sink.write_page(records)
+            METRICS.inc("instascrape_pages_total")
+            METRICS.inc("instascrape_comments_total", len(records))
+            if checkpoint:
+                checkpoint.commit(sink, cursor, has_next, total_count)
+            await sink.drain()
+
+    async def prefetch_pages(after: str, ahead: "asyncio.Queue[Any]"):
+        """Producer: fetch pages along the cursor chain into `ahead`; ends with None or the error."""
+        try:
+            while after:
+                vars2 = {"shortcode": shortcode, "first": COMMENTS_PER_PAGE, "after": after}
+                page = await request(PARENT_QUERY_HASH, vars2, decode_page)
+                await ahead.put(page)
+                after = page.end_cursor if page.has_next else None
+        except Exception as e:
+            await ahead.put(e)
+            return
+        await ahead.put(None)
+
+    bar = None
+    fetcher: Optional["asyncio.Future[None]"] = None
+    try:
+        state = checkpoint.state if checkpoint else None
+        if state:
+            has_next = state.get("has_next", False)
+            cursor = state.get("end_cursor")
+            total_count = max(int(state.get("total_count") or 0), sink.count)
+            done_pages = ceil(sink.count / COMMENTS_PER_PAGE)
+            tqdm.write(f"Resuming {shortcode} from checkpoint: {sink.count} comments already saved.")
+        else:
+            variables = {"shortcode": shortcode, "first": COMMENTS_PER_PAGE}
+            page = await request(PARENT_QUERY_HASH, variables, decode_page)
+
+            struct = page.comments
+            total_count = page.count or len(struct)
+            has_next = page.has_next
+            if seen is not None:
+                has_next = has_next and not seen.known(struct)
+            if comment_filter is not None:
+                has_next = has_next and not comment_filter.exhausted(struct)
+                struct = comment_filter.apply(struct)
+            if seen is not None:
+                # Only what reaches the sink counts as exported; filtered-out comments stay fetchable later.
+                struct = seen.add_new(struct)
+                seen.examine(page.comments)
+            cursor = page.end_cursor
+            done_pages = 1
+            await emit(struct, page.threads, cursor, has_next)
+
+        total_pages = max(1, ceil(total_count / COMMENTS_PER_PAGE), done_pages)
+        bar = tqdm(total=total_pages, desc="Fetching comments", unit="page", leave=True, disable=not progress)
+        bar.update(done_pages)
+
+        # The fetcher follows the cursor chain on its own, up to `ahead` pages
+        # before this loop; it only needs end_cursor to issue the next request, while
+        # filtering, reply threads, sink writes and checkpoints happen here.
+        ahead: "asyncio.Queue[Any]" = asyncio.Queue(maxsize=PREFETCH_PAGES)
+        if has_next and cursor:
+            fetcher = asyncio.ensure_future(prefetch_pages(cursor, ahead))
+        else:
+            ahead.put_nowait(None)
+        while True:
+            page = await ahead.get()
+            if page is None:
+                break
+            if isinstance(page, Exception):
+                raise page
+            s2 = page.comments
+            if seen is not None and seen.known(s2):
+                break
+            done = False
+            if comment_filter is not None:
+                done = comment_filter.exhausted(s2)
+                s2 = comment_filter.apply(s2)
+            if seen is not None:
+                s2 = seen.add_new(s2)
+                seen.examine(page.comments)
+            await emit(s2, page.threads, page.end_cursor, page.has_next and not done)
             bar.update(1)
-            if len(all_flat) > total_count:
-                total_count = len(all_flat)
+            if done:
+                break
+            fetched = sink.count + sum(len(p[0]) for p in pending)
+            if fetched > total_count:
+                total_count = fetched
                 new_total_pages = max(total_pages, ceil(total_count / COMMENTS_PER_PAGE))
                 if new_total_pages != total_pages:
                     bar.total = new_total_pages
                     bar.refresh()
                     total_pages = new_total_pages
-            current_after = next_after
+        await flush(wait=True)
+    finally:
+        if fetcher is not None:
+            fetcher.cancel()
+            await asyncio.gather(fetcher, return_exceptions=True)
+        if bar is not None:
+            bar.close()
+        if replies is not None:
+            await replies.close()
+        if own_pool:
+            await pool.aclose()
+    return sink.count
+
+async def scrape_reel(shortcode: str, session_tuple: Tuple[str, str, str, str], rps: float, base_name: str,
+                      formats: Sequence[str] = DEFAULT_FORMATS,
+                      client: Optional[httpx.AsyncClient] = None,
+                      limiter: Optional[RateLimiter] = None,
+                      progress: bool = True, fresh: bool = False,
+                      options: ScrapeOptions = DEFAULT_OPTIONS) -> Tuple[int, List[str]]:
+    """
+    Full scrape of one reel into its export files, resuming from (and then
+    clearing) its checkpoint. Returns (comments saved, output paths).
+    """
+    ckpt = Checkpoint(shortcode)
+    sink = open_outputs(base_name, formats, ckpt, fresh, shortcode)
+    try:
+        count = await fetch_all_pages(shortcode, session_tuple, rps, client=client, limiter=limiter,
+                                      progress=progress, checkpoint=ckpt, sink=sink, options=options)
+        paths = sink.finalize()
+    finally:
+        sink.close()
+    ckpt.clear()
+    return count, paths
+
+async def refresh_reel(shortcode: str, session_tuple: Tuple[str, str, str, str], rps: float,
+                       formats: Sequence[str] = DEFAULT_FORMATS,
+                       client: Optional[httpx.AsyncClient] = None,
+                       limiter: Optional[RateLimiter] = None,
+                       progress: bool = True,
+                       options: ScrapeOptions = DEFAULT_OPTIONS) -> Tuple[int, List[str]]:
+    """
+    Incremental refresh of one reel: fetch only comments missing from its
+    SeenIndex and merge them, newest first, into the stable
+    reel_comments_<shortcode> exports. NDJSON is always written because it is
+    what the next merge reads back. Returns (new comments, output paths); the
+    existing files are left untouched when nothing is new.
+    """
+    base_name = f"reel_comments_{shortcode}"
+    formats = tuple(formats) if "ndjson" in formats else tuple(formats) + ("ndjson",)
+    previous = output_path(base_name, "ndjson")
+    index = SeenIndex(shortcode)
+    if index.load():
+        if not os.path.exists(previous):
+            tqdm.write(f"! Index for {shortcode} has no matching NDJSON export; fetching everything again.")
+            index.reset()
+        elif index.older_than(previous):
+            # A run died between replacing the exports and saving the index; its comments are in the export.
+            tqdm.write(f"! Index for {shortcode} predates {previous}; catching it up from the export.")
+            for chunk in read_ndjson(previous):
+                index.add_new(chunk)
+    elif os.path.exists(previous):
+        # Without this the whole reel would be fetched again and merged on top of the old export.
+        tqdm.write(f"! Index for {shortcode} is missing or unreadable; rebuilding it from {previous}.")
+        for chunk in read_ndjson(previous):
+            index.add_new(chunk)
+    index.use_filter(options.comment_filter.signature() if options.comment_filter is not None else None)
+
+    sink = MultiSink(base_name, formats, shortcode)
+    try:
+        new = await fetch_all_pages(shortcode, session_tuple, rps, client=client, limiter=limiter,
+                                    progress=progress, sink=sink, seen=index, options=options)
+        if not new:
+            sink.abort()
+            index.save()
+            return 0, []
+        if os.path.exists(previous):
+            for chunk in read_ndjson(previous):
+                sink.write_page(chunk)
+        paths = sink.finalize()
+    finally:
+        sink.close()
+    index.save()
+    return new, paths
+
+async def iter_comment_pages(reel: str, rps: float = DEFAULT_RPS,
+                             client: Optional[httpx.AsyncClient] = None,
+                             session_tuple: Optional[Tuple[str, str, str, str]] = None,
+                             credentials: Optional[str] = None, adaptive: bool = True,
+                             options: ScrapeOptions = DEFAULT_OPTIONS) -> AsyncIterator[List[codec.Comment]]:
+    """
+    Yield the parent comments of one reel (URL or shortcode) page by page as
+    they arrive, without prompts, progress bars or files:
+
+        async for page in iter_comment_pages("SHORTCODE", rps=5):
+            for c in page:
+                print(c["username"], c["text"])
+
+    Logins use cookie.json (or `session_tuple`) and relogin non-interactively
+    from `credentials` (a JSON file) or the environment; pass a pool in
+    `options` and/or a shared client to run several reels under one budget.
+    Leaving the loop early stops fetching.
+    """
+    shortcode = extract_shortcode(reel) or (reel if SHORTCODE_RE.fullmatch(reel) else None)
+    if not shortcode:
+        raise ValueError(f"Not a reel URL or shortcode: {reel!r}")
+    own_pool = options.pool is None
+    pool = options.pool or single_session_pool(session_tuple, make_limiter(rps, adaptive),
+                                               credential_source(interactive=False, path=credentials))
+    options = options._replace(pool=pool)
+    # Bounded: fetching pauses while the consumer is PREFETCH_PAGES pages behind.
+    pages: "asyncio.Queue[Any]" = asyncio.Queue(maxsize=PREFETCH_PAGES)
+
+    async def produce():
+        try:
+            await fetch_all_pages(shortcode, session_tuple, rps, client=client, progress=False,
+                                  sink=QueueSink(pages), options=options)
+        except Exception as e:
+            await pages.put(e)
+            return
+        await pages.put(None)
+
+    producer = asyncio.ensure_future(produce())
+    try:
+        while True:
+            page = await pages.get()
+            if page is None:
+                return
+            if isinstance(page, Exception):
+                raise page
+            if page:
+                yield page
+    finally:
+        producer.cancel()
+        await asyncio.gather(producer, return_exceptions=True)
+        if own_pool:
+            await pool.aclose()
+
+async def for_each_reel(shortcodes: List[str], session_tuple: Tuple[str, str, str, str], rps: float, concurrency: int,
+                        scrape_one, limiter: Optional[RateLimiter] = None, source: Optional[CredentialSource] = None,
+                        progress: bool = True, desc: str = "Scraping reels",
+                        options: ScrapeOptions = DEFAULT_OPTIONS,
+                        on_done: Optional[Callable[[Dict[str, Any]], None]] = None) -> List[Dict[str, Any]]:
+    """
+    Run `await scrape_one(shortcode, client, options)` for every reel, `concurrency`
+    at a time, over one pooled HTTP/2 client and one SessionPool. Without a pool
+    in `options`, a single session paced by one RateLimiter (adaptive unless
+    given) is used, so `rps` is the budget for the whole batch; with a
+    multi-account pool every account has its own budget. scrape_one() returns the
+    reel's comment count; an exception is recorded in that reel's result instead
+    of aborting the run. `on_done`, if given, is called with each reel's result
+    as it finishes.
+    """
+    concurrency = max(1, min(concurrency, len(shortcodes) or 1))
+    own_pool = options.pool is None
+    pool = options.pool or single_session_pool(session_tuple, limiter or make_limiter(rps),
+                                               source or credential_source(interactive=False))
+    options = options._replace(pool=pool)
+    queue: "asyncio.Queue[str]" = asyncio.Queue()
+    for sc in shortcodes:
+        queue.put_nowait(sc)
+    results: Dict[str, Dict[str, Any]] = {}
 
-        bar.close()
-        return all_flat, all_struct
+    async with make_client(max_connections=max(20, concurrency * 2), base_url=options.base_url) as client:
+        bar = tqdm(total=len(shortcodes), desc=desc, unit="reel", leave=True, disable=not progress)
+
+        async def worker():
+            while True:
+                try:
+                    sc = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                started = time.perf_counter()
+                count, error = 0, None
+                try:
+                    count = await scrape_one(sc, client, options)
+                except Exception as e:
+                    error = f"{type(e).__name__}: {e}"
+                results[sc] = {"shortcode": sc, "comments": count, "error": error,
+                               "seconds": round(time.perf_counter() - started, 2)}
+                bar.update(1)
+                if on_done:
+                    on_done(results[sc])
+
+        try:
+            await asyncio.gather(*(worker() for _ in range(concurrency)))
+        finally:
+            bar.close()
+            if own_pool:
+                await pool.aclose()
+
+    return [results[sc] for sc in shortcodes if sc in results]
+
+async def run_batch(shortcodes: List[str], session_tuple: Tuple[str, str, str, str], rps: float,
+                    concurrency: int = DEFAULT_CONCURRENCY, fresh: bool = False,
+                    formats: Sequence[str] = DEFAULT_FORMATS, incremental: bool = False,
+                    limiter: Optional[RateLimiter] = None, source: Optional[CredentialSource] = None,
+                    progress: bool = True, timestamp: Optional[str] = None,
+                    options: ScrapeOptions = DEFAULT_OPTIONS,
+                    on_done: Optional[Callable[[Dict[str, Any]], None]] = None) -> List[Dict[str, Any]]:
+    """
+    Scrape many reels concurrently (see for_each_reel()), each into its own
+    reel_comments_<shortcode>_<timestamp> exports. A failing reel keeps its
+    checkpoint and partial files so the next batch resumes it. In incremental
+    mode "comments" in the summary counts new comments only.
+    """
+    timestamp = timestamp or datetime.now().strftime("%Y%m%d_%H%M%S")
+
+    async def scrape_one(sc: str, client: httpx.AsyncClient, options: ScrapeOptions) -> int:
+        if incremental:
+            count, _ = await refresh_reel(sc, session_tuple, rps, formats, client=client, progress=False,
+                                          options=options)
+        else:
+            count, _ = await scrape_reel(sc, session_tuple, rps, f"reel_comments_{sc}_{timestamp}", formats,
+                                         client=client, progress=False, fresh=fresh, options=options)
+        return count
+
+    return await for_each_reel(shortcodes, session_tuple, rps, concurrency, scrape_one, limiter, source, progress,
+                               options=options, on_done=on_done)
+
+async def probe_reels(shortcodes: List[str], session_tuple: Tuple[str, str, str, str], rps: float,
+                      concurrency: int = DEFAULT_CONCURRENCY, path: str = PROBE_FILE,
+                      limiter: Optional[RateLimiter] = None, source: Optional[CredentialSource] = None,
+                      progress: bool = True, options: ScrapeOptions = DEFAULT_OPTIONS) -> List[Dict[str, Any]]:
+    """
+    Count-only probe: request just the first page (PROBE_PAGE_SIZE comments) of
+    every reel like run_batch(), and append a `shortcode,count,timestamp` row per
+    reel to the CSV at `path` as results come in. Probes never use the response
+    cache, so every row is a count fetched at its timestamp. Returns
+    run_batch()-style results with "comments" holding the count.
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    new_file = not os.path.exists(path) or os.path.getsize(path) == 0
+
+    with open(path, "a", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        if new_file:
+            writer.writerow(("shortcode", "count", "timestamp"))
+
+        async def probe_one(sc: str, client: httpx.AsyncClient, options: ScrapeOptions) -> int:
+            variables = {"shortcode": sc, "first": PROBE_PAGE_SIZE}
+            page = await pool_request(client, options.pool, sc, PARENT_QUERY_HASH, variables, codec.decode_parent_page)
+            writer.writerow((sc, page.count, int(time.time())))
+            f.flush()
+            return page.count
+
+        return await for_each_reel(shortcodes, session_tuple, rps, concurrency, probe_one, limiter, source, progress,
+                                   "Probing reels", options._replace(cache=None))
+
+def print_batch_summary(results: List[Dict[str, Any]]):
+    ok = [r for r in results if not r["error"]]
+    failed = [r for r in results if r["error"]]
+    print(f"Batch finished: {len(ok)} succeeded, {len(failed)} failed, {sum(r['comments'] for r in ok)} comments total.")
+    for r in failed:
+        print(f" ! {r['shortcode']}: {r['error']}")
 
 def prompt_rps() -> float:
     while True:
@@ -235,21 +1107,238 @@ def prompt_rps() -> float:
         except ValueError:
             print("Enter a numeric value like 1, 2.5, 5.")
 
-def load_or_login_get_cookies_interactive() -> Tuple[str, str, str, str]:
+def load_or_login_get_cookies_interactive(source: Optional[CredentialSource] = None) -> Tuple[str, str, str, str]:
     dj = read_cookie_json()
     if cookie_json_valid(dj):
         c = dj["cookies"]
         return c["sessionid"], c["csrftoken"], c["mid"], c["ds_user_id"]
     print("Saved login expired or missing. Please login again.")
-    username = input("Enter your username: ").strip()
-    password = input("Enter your instagram password: ").strip()
+    username, password = (source or credential_source()).get()
     print("Logging in to your account to fetch cookies...")
     sessionid, csrftoken, mid, dsuserid = login_instagram(username, password)
     print("Cookies fetched successfully.")
     write_cookie_json(sessionid, csrftoken, mid, dsuserid)
     return sessionid, csrftoken, mid, dsuserid
 
-async def amain():
+def parse_formats(value: str) -> Tuple[str, ...]:
+    formats = tuple(dict.fromkeys(f.strip().lower() for f in value.split(",") if f.strip()))
+    unknown = [f for f in formats if f not in FILE_SINKS]
+    if not formats or unknown:
+        raise argparse.ArgumentTypeError(f"choose from: {', '.join(FILE_SINKS)}")
+    missing = missing_dependencies(formats)
+    if missing:
+        raise argparse.ArgumentTypeError(", ".join(f"{fmt} needs 'pip install {mod}'" for fmt, mod in missing.items()))
+    return formats
+
+def positive_float(value: str) -> float:
+    try:
+        number = float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"not a number: {value!r}")
+    if not number > 0:
+        raise argparse.ArgumentTypeError("must be greater than 0")
+    return number
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    ap = argparse.ArgumentParser(description="Scrape parent comments from Instagram reels. "
+                                             "Without reels or --batch, prompts for one reel URL.")
+    ap.add_argument("reels", nargs="*", metavar="REEL",
+                    help="reel URLs or shortcodes to scrape non-interactively (like --batch)")
+    ap.add_argument("--batch", metavar="FILE", help="scrape reel URLs/shortcodes listed in FILE ('-' for stdin) non-interactively")
+    ap.add_argument("--rps", type=positive_float,
+                    help=f"max requests per second for the whole run, or per account with --accounts/--cookie-dir "
+                         f"(batch default: {DEFAULT_RPS})")
+    ap.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY, help="reels scraped at the same time in batch mode")
+    ap.add_argument("--workers", type=int, default=1,
+                    help="split a batch over this many processes, each with a share of --rps and --concurrency "
+                         "(with --accounts: a share of the accounts)")
+    ap.add_argument("--credentials", metavar="FILE",
+                    help=f"JSON file with \"username\"/\"password\" used for logins instead of prompting "
+                         f"(or set {USERNAME_ENV}/{PASSWORD_ENV})")
+    ap.add_argument("--accounts", metavar="FILE",
+                    help="JSON list of {\"username\", \"password\"} objects; requests are spread over all of them")
+    ap.add_argument("--cookie-dir", metavar="DIR",
+                    help=f"directory of per-account <username>.json cookie files for --accounts (default: {DEFAULT_COOKIE_DIR})")
+    ap.add_argument("--fixed-rate", action="store_true",
+                    help="always send at --rps instead of adapting the rate to 429s, errors and latency")
+    ap.add_argument("--fresh", action="store_true", help="discard saved checkpoints and start every reel from the first page")
+    ap.add_argument("--incremental", action="store_true",
+                    help="only fetch comments not seen by earlier incremental runs and merge them into reel_comments_<shortcode>")
+    ap.add_argument("--probe", nargs="?", const=PROBE_FILE, metavar="CSV",
+                    help=f"only fetch each reel's comment count and append shortcode,count,timestamp rows to CSV "
+                         f"(default: {PROBE_FILE})")
+    ap.add_argument("--since", type=parse_since, metavar="WHEN",
+                    help="only keep comments posted since WHEN (Unix time, ISO date or an age like 24h, 7d) and stop "
+                         "paginating at the first page that reaches past it")
+    ap.add_argument("--match", type=parse_regex, metavar="REGEX", help="only keep comments whose text matches REGEX (case-insensitive)")
+    ap.add_argument("--user", action="append", metavar="NAME",
+                    help="only keep comments by NAME (repeat or comma-separate for several)")
+    ap.add_argument("--replies", action="store_true", help="also fetch reply threads and nest them under each parent comment")
+    ap.add_argument("--reply-workers", type=int, default=DEFAULT_REPLY_WORKERS,
+                    help="reply threads fetched at the same time per reel (with --replies)")
+    ap.add_argument("--formats", type=parse_formats, default=DEFAULT_FORMATS, metavar="LIST",
+                    help=f"comma-separated output formats: {', '.join(FILE_SINKS)} (default: {','.join(DEFAULT_FORMATS)})")
+    ap.add_argument("--output-dir", default=OUTPUT_DIR, metavar="DIR",
+                    help=f"write exports, checkpoints and the incremental index under DIR (default: {OUTPUT_DIR})")
+    ap.add_argument("--base-url", metavar="URL",
+                    help="send GraphQL requests to URL instead of Instagram (e.g. a local bench.py server)")
+    ap.add_argument("--cache", nargs="?", const=DEFAULT_CACHE_PATH, metavar="FILE",
+                    help=f"reuse GraphQL responses fetched in the last --cache-ttl seconds from an on-disk cache "
+                         f"(default file: {DEFAULT_CACHE_PATH})")
+    ap.add_argument("--cache-ttl", type=float, default=DEFAULT_CACHE_TTL, metavar="SECONDS",
+                    help=f"how long cached responses stay fresh (default: {DEFAULT_CACHE_TTL:g})")
+    ap.add_argument("--cache-max-mb", type=float, default=DEFAULT_CACHE_MB, metavar="MB",
+                    help=f"evict least recently used responses beyond this size (default: {DEFAULT_CACHE_MB})")
+    ap.add_argument("--cache-bypass", action="store_true",
+                    help="fetch everything again, but still store the fresh responses in --cache")
+    ap.add_argument("--no-progress", action="store_true", help="hide the progress bars (for logs and cron jobs)")
+    ap.add_argument("--metrics-port", type=int, metavar="PORT",
+                    help="serve Prometheus metrics at http://127.0.0.1:PORT/metrics while the run lasts")
+    ap.add_argument("--stats-file", metavar="FILE", help="append a JSON line of metrics to FILE periodically and at the end")
+    ap.add_argument("--stats-interval", type=float, default=DEFAULT_STATS_INTERVAL, metavar="SECONDS",
+                    help=f"seconds between --stats-file lines (default: {DEFAULT_STATS_INTERVAL:g})")
+    args = ap.parse_args(argv)
+    if args.probe and not (args.reels or args.batch):
+        ap.error("--probe needs reels to probe, as arguments or with --batch")
+    if args.probe and args.workers > 1:
+        ap.error("--probe runs in a single process; drop --workers")
+    return args
+
+def pool_from_args(args: Optional[argparse.Namespace], rps: float,
+                   only: Optional[Sequence[str]] = None) -> Optional[SessionPool]:
+    """A multi-account SessionPool when --accounts or --cookie-dir is given, else None."""
+    if args is None or not (args.accounts or args.cookie_dir):
+        return None
+    accounts = load_accounts(args.accounts) if args.accounts else None
+    pool = load_session_pool(args.cookie_dir or DEFAULT_COOKIE_DIR,
+                             lambda: make_limiter(rps, adaptive=not args.fixed_rate), accounts, only)
+    pool.prepare()
+    return pool
+
+def filter_from_args(args: Optional[argparse.Namespace]) -> Optional[CommentFilter]:
+    if args is None or not (args.since is not None or args.match or args.user):
+        return None
+    users = [u.strip() for value in args.user or [] for u in value.split(",") if u.strip()]
+    return CommentFilter(args.since, args.match, users or None)
+
+def cache_from_args(args: Optional[argparse.Namespace]) -> Optional[ResponseCache]:
+    if args is None or not args.cache:
+        return None
+    return ResponseCache(args.cache, args.cache_ttl, int(args.cache_max_mb * 1024 * 1024), args.cache_bypass)
+
+def print_rate(pool: Optional[SessionPool], limiter: RateLimiter):
+    if pool is None:
+        print(f"Rate: {limiter.report()}")
+        return
+    print("Sessions:")
+    for line in pool.report():
+        print(f" - {line}")
+
+def print_metrics():
+    print(f"Time: {METRICS.summary()}")
+
+def reply_workers_from_args(args: Optional[argparse.Namespace]) -> int:
+    if args is None or not args.replies:
+        return 0
+    return max(1, args.reply_workers)
+
+def options_from_args(args: Optional[argparse.Namespace], pool: Optional[SessionPool] = None) -> ScrapeOptions:
+    """ScrapeOptions for a run; the caller closes its cache (and pool)."""
+    return ScrapeOptions(pool=pool, reply_workers=reply_workers_from_args(args),
+                         base_url=args.base_url if args is not None else None,
+                         cache=cache_from_args(args), comment_filter=filter_from_args(args))
+
+async def amain_batch(args: argparse.Namespace) -> int:
+    shortcodes = parse_shortcodes(args.reels + (read_shortcodes(args.batch) if args.batch else []))
+    if not shortcodes:
+        print("! No valid shortcodes to scrape.")
+        return 1
+    rps = args.rps or DEFAULT_RPS
+    if args.workers > 1:
+        return await amain_sharded(args, shortcodes, rps)
+    # Batch runs never prompt: logins come from --credentials, --accounts or the environment.
+    pool = pool_from_args(args, rps)
+    verb = "Probing" if args.probe else "Scraping"
+    if pool is None:
+        source = credential_source(interactive=False, path=args.credentials)
+        session_tuple = load_or_login_get_cookies_interactive(source)
+        print(f"{verb} {len(shortcodes)} reels at up to {rps:g} req/s with concurrency {args.concurrency}...")
+    else:
+        source, session_tuple = None, None
+        print(f"{verb} {len(shortcodes)} reels with {len(pool.sessions)} accounts at up to {rps:g} req/s each, "
+              f"concurrency {args.concurrency}...")
+    limiter = make_limiter(rps, adaptive=not args.fixed_rate)
+    options = options_from_args(args, pool)
+    if args.probe:
+        try:
+            results = await probe_reels(shortcodes, session_tuple, rps, args.concurrency, args.probe, limiter=limiter,
+                                        source=source, progress=not args.no_progress, options=options)
+        finally:
+            if options.cache:
+                options.cache.close()
+            if pool is not None:
+                await pool.aclose()
+        failed = [r for r in results if r["error"]]
+        print(f"Probed {len(results) - len(failed)} reels ({len(failed)} failed); counts appended to {args.probe}.")
+        for r in failed:
+            print(f" ! {r['shortcode']}: {r['error']}")
+        print_rate(pool, limiter)
+        return 1 if failed else 0
+    try:
+        results = await run_batch(shortcodes, session_tuple, rps, args.concurrency, fresh=args.fresh,
+                                  formats=args.formats, incremental=args.incremental, limiter=limiter,
+                                  source=source, progress=not args.no_progress, options=options)
+    finally:
+        if options.cache:
+            options.cache.close()
+        if pool is not None:
+            await pool.aclose()
+    print_batch_summary(results)
+    print_rate(pool, limiter)
+    print_metrics()
+    return 1 if any(r["error"] for r in results) else 0
+
+async def amain_sharded(args: argparse.Namespace, shortcodes: List[str], rps: float) -> int:
+    # Log in once up front so the workers start from valid cookie files.
+    pool = pool_from_args(args, rps)
+    if pool is None:
+        load_or_login_get_cookies_interactive(credential_source(interactive=False, path=args.credentials))
+        accounts = None
+    else:
+        await pool.settle()
+        await pool.aclose()
+        accounts = [s.name for s in pool.sessions if s.healthy]
+        if not accounts:
+            raise LoginError("No usable sessions left.")
+    plan = shards.plan_shards(shortcodes, args.workers, rps, args.concurrency, accounts)
+    budget = f"{len(accounts)} accounts at up to {rps:g} req/s each" if accounts else f"up to {rps:g} req/s in total"
+    print(f"Scraping {len(shortcodes)} reels in {len(plan)} worker processes with {budget}, "
+          f"concurrency {plan[0].concurrency} per worker...")
+    results, reports = await shards.run_sharded(plan, args, progress=not args.no_progress)
+    print_batch_summary(results)
+    print("Workers:")
+    for line in reports:
+        print(f" - {line}")
+    print_metrics()
+    return 1 if any(r["error"] for r in results) else 0
+
+async def amain(args: Optional[argparse.Namespace] = None) -> int:
+    if args is not None:
+        set_output_dir(args.output_dir)
+    if args is not None and args.metrics_port:
+        serve_prometheus(args.metrics_port)
+    stats = StatsFile(args.stats_file, args.stats_interval) if args is not None and args.stats_file else None
+    if stats:
+        stats.start()
+    try:
+        if args is not None and (args.batch or args.reels):
+            return await amain_batch(args)
+        return await amain_single(args)
+    finally:
+        if stats:
+            await stats.stop()
+
+async def amain_single(args: Optional[argparse.Namespace]) -> int:
     reel_url = input("Enter Instagram Reel URL: ").strip()
     shortcode = extract_shortcode(reel_url)
     if not shortcode:
@@ -257,17 +1346,47 @@ async def amain():
         print("Url format should be: 'https://www.instagram.com/reel/<shortcode>'")
         sys.exit(1)
 
-    rps = prompt_rps()
-    sessionid, csrftoken, mid, dsuserid = load_or_login_get_cookies_interactive()
-    comments_flat, comments_struct = await fetch_all_pages(shortcode, (sessionid, csrftoken, mid, dsuserid), rps)
-
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    base_name = f"reel_comments_{timestamp}"
-    write_outputs(base_name, comments_flat, comments_struct)
+    rps = args.rps if args is not None and args.rps else prompt_rps()
+    formats = args.formats if args is not None else DEFAULT_FORMATS
+    limiter = make_limiter(rps, adaptive=not (args is not None and args.fixed_rate))
+    pool = pool_from_args(args, rps)
+    if pool is None:
+        source = credential_source(interactive=True, path=args.credentials if args is not None else None)
+        session_tuple = load_or_login_get_cookies_interactive(source)
+        pool = single_session_pool(session_tuple, limiter, source)
+        multi = False
+    else:
+        session_tuple, multi = None, True
+    progress = not (args is not None and args.no_progress)
+    options = options_from_args(args, pool)
+    try:
+        if args is not None and args.incremental:
+            new, paths = await refresh_reel(shortcode, session_tuple, rps, formats, limiter=limiter, progress=progress,
+                                            options=options)
+            if not new:
+                print("No new comments since the last run.")
+            else:
+                print(f"Merged {new} new comments:")
+                for path in paths:
+                    print(f" - {path}")
+        else:
+            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+            count, paths = await scrape_reel(shortcode, session_tuple, rps, f"reel_comments_{timestamp}", formats,
+                                             limiter=limiter, progress=progress, fresh=args is not None and args.fresh,
+                                             options=options)
+            print_saved(count, paths)
+    finally:
+        if options.cache:
+            options.cache.close()
+        await pool.aclose()
+    print_rate(pool if multi else None, limiter)
+    print_metrics()
+    return 0
 
 def main():
+    args = parse_args()
     try:
-        asyncio.run(amain())
+        code = asyncio.run(amain(args))
     except LoginError as le:
         print(f"Login error: {le}")
         sys.exit(1)
@@ -283,6 +1402,8 @@ def main():
     except Exception as e:
         print(f"Unexpected error: {e}")
         sys.exit(1)
+    if code:
+        sys.exit(code)
 
 if __name__ == "__main__":
     main()
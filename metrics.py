@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+"""
+Process-wide counters and histograms for the fetch pipeline.
+
+Everything records into METRICS. It can be scraped as Prometheus text
+(serve_prometheus()) or appended as JSON lines (StatsFile).
+"""
+
+import asyncio
+import json
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+DEFAULT_STATS_INTERVAL = 10.0
+
+Labels = Tuple[Tuple[str, str], ...]
+
+HELP = {
+    "instascrape_requests_total": "GraphQL responses received, by query and HTTP status.",
+    "instascrape_request_seconds": "Network time per GraphQL request (send to full body).",
+    "instascrape_response_bytes_total": "Response body bytes received.",
+    "instascrape_decode_seconds": "Time spent decoding a GraphQL response into records.",
+    "instascrape_limiter_wait_seconds": "Time a request waited on its rate limiter.",
+    "instascrape_retries_total": "Requests retried, by reason.",
+    "instascrape_reauth_total": "Background relogins started, by session.",
+    "instascrape_cache_total": "Response cache lookups, by result (hit, revalidated, miss).",
+    "instascrape_pages_total": "Parent comment pages handed to the sink.",
+    "instascrape_comments_total": "Parent comments handed to the sink.",
+    "instascrape_sink_write_seconds": "Time spent writing one page, by output format.",
+    "instascrape_sink_sync_seconds": "Time spent flushing/fsyncing outputs at a checkpoint, by output format.",
+}
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding the q-th observation (the last finite bound for +Inf)."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return self.buckets[min(i, len(self.buckets) - 1)]
+        return self.buckets[-1]
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {"count": self.count, "sum": round(self.sum, 6),
+                "p50": self.quantile(0.5), "p99": self.quantile(0.99)}
+
+class Metrics:
+    """A small registry of labelled counters and histograms."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters: Dict[str, Dict[Labels, float]] = {}
+        self.histograms: Dict[str, Dict[Labels, Histogram]] = {}
+        self.started = time.time()
+
+    def inc(self, name: str, value: float = 1, **labels: str):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels: str):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self.histograms.setdefault(name, {})
+            hist = series.get(key)
+            if hist is None:
+                hist = series[key] = Histogram()
+            hist.observe(value)
+
+    @contextmanager
+    def timer(self, name: str, **labels: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def total(self, name: str) -> float:
+        """Sum of a counter, or of a histogram's observations, over all labels."""
+        with self._lock:
+            if name in self.counters:
+                return sum(self.counters[name].values())
+            return sum(h.sum for h in self.histograms.get(name, {}).values())
+
+    def export(self) -> Dict[str, Any]:
+        """Raw series in a picklable form, for merge() into another process's registry."""
+        with self._lock:
+            return {
+                "counters": {name: dict(series) for name, series in self.counters.items()},
+                "histograms": {name: {k: (h.buckets, list(h.counts), h.sum, h.count) for k, h in series.items()}
+                               for name, series in self.histograms.items()},
+            }
+
+    def merge(self, exported: Dict[str, Any]):
+        """Add the series of another registry's export() to this one."""
+        with self._lock:
+            for name, series in exported["counters"].items():
+                mine = self.counters.setdefault(name, {})
+                for key, value in series.items():
+                    mine[key] = mine.get(key, 0) + value
+            for name, series in exported["histograms"].items():
+                mine_h = self.histograms.setdefault(name, {})
+                for key, (buckets, counts, total, count) in series.items():
+                    hist = mine_h.get(key)
+                    if hist is None:
+                        hist = mine_h[key] = Histogram(buckets)
+                    hist.counts = [a + b for a, b in zip(hist.counts, counts)]
+                    hist.sum += total
+                    hist.count += count
+
+    def series_value(self, name: str, **labels: str) -> float:
+        """Current value of one counter series."""
+        with self._lock:
+            return self.counters.get(name, {}).get(tuple(sorted(labels.items())), 0)
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+            self.started = time.time()
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "ts": round(time.time(), 3),
+                "uptime": round(time.time() - self.started, 3),
+                "counters": {name: [dict(k, value=v) for k, v in series.items()]
+                             for name, series in self.counters.items()},
+                "histograms": {name: [dict(k, **h.snapshot()) for k, h in series.items()]
+                               for name, series in self.histograms.items()},
+            }
+
+    def prometheus_text(self) -> str:
+        lines: List[str] = []
+        with self._lock:
+            for name, series in sorted(self.counters.items()):
+                lines += [f"# HELP {name} {HELP.get(name, name)}", f"# TYPE {name} counter"]
+                lines += [f"{name}{_labels(k)} {_number(v)}" for k, v in series.items()]
+            for name, series in sorted(self.histograms.items()):
+                lines += [f"# HELP {name} {HELP.get(name, name)}", f"# TYPE {name} histogram"]
+                for k, h in series.items():
+                    cumulative = 0
+                    for bound, n in zip(h.buckets + (float("inf"),), h.counts):
+                        cumulative += n
+                        le = "+Inf" if bound == float("inf") else _number(bound)
+                        lines.append(f"{name}_bucket{_labels(k + (('le', le),))} {cumulative}")
+                    lines.append(f"{name}_sum{_labels(k)} {_number(h.sum)}")
+                    lines.append(f"{name}_count{_labels(k)} {h.count}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> str:
+        return (f"network {self.total('instascrape_request_seconds'):.1f}s, "
+                f"limiter wait {self.total('instascrape_limiter_wait_seconds'):.1f}s, "
+                f"decode {self.total('instascrape_decode_seconds'):.2f}s, "
+                f"writes {self.total('instascrape_sink_write_seconds') + self.total('instascrape_sink_sync_seconds'):.2f}s, "
+                f"{int(self.total('instascrape_retries_total'))} retries, "
+                f"{int(self.total('instascrape_reauth_total'))} reauths, "
+                f"{int(self.series_value('instascrape_cache_total', result='hit') + self.series_value('instascrape_cache_total', result='revalidated'))} cache hits, "
+                f"{self.total('instascrape_response_bytes_total') / 1e6:.1f} MB received")
+
+def _number(v: float) -> str:
+    return str(int(v)) if float(v).is_integer() else repr(float(v))
+
+def _labels(key: Labels) -> str:
+    if not key:
+        return ""
+    body = ",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in key)
+    return "{" + body + "}"
+
+METRICS = Metrics()
+
+def serve_prometheus(port: int, host: str = "127.0.0.1", registry: Metrics = METRICS) -> ThreadingHTTPServer:
+    """Expose `registry` at http://host:port/metrics from a daemon thread; returns the server."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+            body = registry.prometheus_text().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    return server
+
+class StatsFile:
+    """Appends a METRICS snapshot as one JSON line every `interval` seconds, and once more on stop()."""
+
+    def __init__(self, path: str, interval: float = DEFAULT_STATS_INTERVAL, registry: Metrics = METRICS):
+        self.path = path
+        self.interval = interval
+        self.registry = registry
+        self._task: Optional[asyncio.Task] = None
+
+    def write(self):
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(self.registry.snapshot(), separators=(",", ":")) + "\n")
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            self.write()
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        self.write()
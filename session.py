@@ -0,0 +1,363 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import json
+import os
+import time
+from abc import ABC, abstractmethod
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import login
+from metrics import METRICS
+from login import (
+    login_instagram_async, make_login_client, read_cookie_json, write_cookie_json, cookie_json_valid, LoginError,
+)
+
+CREDENTIAL_CHECK_INTERVAL = 1.0
+MAX_REFRESHES = 3
+USERNAME_ENV = "INSTASCRAPE_USERNAME"
+PASSWORD_ENV = "INSTASCRAPE_PASSWORD"
+
+def cookies_string(sessionid: str, csrftoken: str, mid: str, dsuserid: str) -> str:
+    return f"sessionid={sessionid}; ds_user_id={dsuserid}; csrftoken={csrftoken}; mid={mid}"
+
+def build_headers(shortcode: str, cookies_str: str) -> Dict[str, str]:
+    return {
+        "User-Agent": "Mozilla/5.0 (Linux; Android 13; SM-A125F) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Mobile Safari/537.36",
+        "Accept": "*/*",
+        "Accept-Language": "en-US,en;q=0.9",
+        "X-Requested-With": "XMLHttpRequest",
+        "X-IG-App-ID": "936619743392459",
+        "Referer": f"https://www.instagram.com/reel/{shortcode}/",
+        "Cookie": cookies_str,
+    }
+
+class CredentialCache:
+    """
+    In-process view of a cookie.json shared by every request of a run.
+
+    The file is stat()ed at most once per `check_interval` and only re-read when
+    its mtime/size change or the stored overall_expiry passes. Only the Cookie
+    header string is cached; `generation` increments whenever the cookies
+    actually change. Nothing here awaits, so concurrent
+    tasks on one event loop can share an instance.
+    """
+
+    def __init__(self, fallback: Optional[Tuple[str, str, str, str]] = None, path: Optional[str] = None,
+                 check_interval: float = CREDENTIAL_CHECK_INTERVAL):
+        self.path = path or login.COOKIE_JSON_PATH
+        self.fallback = fallback
+        self.check_interval = check_interval
+        self.generation = 0
+        self._cookies: Optional[Tuple[str, str, str, str]] = None
+        self._cookie_str: Optional[str] = None
+        self._stamp: Optional[Tuple[int, int]] = None
+        self._expires_at = 0.0
+        self._checked_at = 0.0
+        self._stale = False
+
+    def _file_stamp(self) -> Optional[Tuple[int, int]]:
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def _reload(self, stamp: Optional[Tuple[int, int]]):
+        d = read_cookie_json(self.path)
+        if cookie_json_valid(d):
+            c = d["cookies"]
+            cookies = (c["sessionid"], c["csrftoken"], c["mid"], c["ds_user_id"])
+            expires_at = float(d["overall_expiry"])
+        elif self.fallback:
+            cookies = tuple(self.fallback)
+            expires_at = float("inf")
+        else:
+            raise LoginError(f"No valid saved login in {self.path}.")
+        if cookies != self._cookies:
+            self._cookies = cookies
+            self._cookie_str = cookies_string(*cookies)
+            self.generation += 1
+        self._stamp = stamp
+        self._expires_at = expires_at
+
+    def _ensure_fresh(self):
+        now = time.time()
+        if (self._cookies is not None and not self._stale and now < self._expires_at
+                and now - self._checked_at < self.check_interval):
+            return
+        self._checked_at = now
+        stamp = self._file_stamp()
+        if self._cookies is None or self._stale or stamp != self._stamp or now >= self._expires_at:
+            self._reload(stamp)
+            self._stale = False
+
+    def replace(self, cookies: Tuple[str, str, str, str]):
+        """Adopt freshly issued cookies (already written to the file) as a new generation."""
+        self._cookies = tuple(cookies)
+        self._cookie_str = cookies_string(*cookies)
+        self.generation += 1
+        self._stamp = self._file_stamp()
+        self._expires_at = float("inf")
+        self._checked_at = 0.0
+        self._stale = False
+
+    def invalidate(self):
+        """Force a re-read on next use, e.g. right after a relogin wrote the file."""
+        self._stale = True
+
+    def cookies(self) -> Tuple[str, str, str, str]:
+        self._ensure_fresh()
+        return self._cookies
+
+    def headers(self, shortcode: str) -> Dict[str, str]:
+        self._ensure_fresh()
+        return build_headers(shortcode, self._cookie_str)
+
+class CredentialSource(ABC):
+    """Where a relogin gets its username and password. get() may block; callers run it off the event loop."""
+
+    @abstractmethod
+    def get(self) -> Tuple[str, str]:
+        ...
+
+class PromptCredentials(CredentialSource):
+    def get(self) -> Tuple[str, str]:
+        username = input("Enter your username: ").strip()
+        password = input("Enter your instagram password: ").strip()
+        return username, password
+
+class StaticCredentials(CredentialSource):
+    def __init__(self, username: str, password: str):
+        self.username = username
+        self.password = password
+
+    def get(self) -> Tuple[str, str]:
+        return self.username, self.password
+
+class NoCredentials(CredentialSource):
+    def get(self) -> Tuple[str, str]:
+        raise LoginError(f"Login required but no credentials configured; set {USERNAME_ENV}/{PASSWORD_ENV} "
+                         f"or pass --credentials.")
+
+def credential_source(interactive: bool = True, path: Optional[str] = None) -> CredentialSource:
+    """
+    Credentials for (re)logins: a JSON file with "username"/"password" if given,
+    else the INSTASCRAPE_USERNAME/INSTASCRAPE_PASSWORD environment variables,
+    else a terminal prompt when interactive.
+    """
+    if path:
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                d = json.load(f)
+            return StaticCredentials(d["username"], d["password"])
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            raise LoginError(f"Unreadable credentials file {path}: {e}")
+    username, password = os.environ.get(USERNAME_ENV), os.environ.get(PASSWORD_ENV)
+    if username and password:
+        return StaticCredentials(username, password)
+    return PromptCredentials() if interactive else NoCredentials()
+
+class Session:
+    """
+    One account: its CredentialCache, its own rate limiter, health counters and
+    a single-flight relogin.
+
+    Callers note `generation` together with the headers they sent. When a
+    request fails auth they call refresh(generation): the first caller logs in
+    (asynchronously, so the event loop keeps serving other requests) while
+    the rest wait on the lock and return as soon as they see the generation
+    moved on. `refreshes` counts relogins since a request last went through, so
+    only an account that keeps failing right after logging in gives up.
+    """
+
+    def __init__(self, credentials: CredentialCache, source: Optional[CredentialSource] = None,
+                 max_refreshes: int = MAX_REFRESHES, limiter=None, name: str = "default"):
+        self.credentials = credentials
+        self.source = source or PromptCredentials()
+        self.max_refreshes = max_refreshes
+        self.limiter = limiter
+        self.name = name
+        self.refreshes = 0
+        self.healthy = True
+        self.refreshing = False
+        self.in_flight = 0
+        self.requests = 0
+        self.auth_failures = 0
+        self.last_error: Optional[str] = None
+        self._lock = asyncio.Lock()
+
+    @property
+    def generation(self) -> int:
+        return self.credentials.generation
+
+    def headers(self, shortcode: str) -> Tuple[int, Dict[str, str]]:
+        hdrs = self.credentials.headers(shortcode)
+        return self.credentials.generation, hdrs
+
+    async def refresh(self, seen_generation: int, login_client=None):
+        async with self._lock:
+            if self.credentials.generation != seen_generation:
+                return
+            # Another process (or a manual login) may already have rewritten the file.
+            self.credentials.invalidate()
+            try:
+                self.credentials.cookies()
+            except LoginError:
+                pass
+            if self.credentials.generation != seen_generation:
+                return
+            if self.refreshes >= self.max_refreshes:
+                raise LoginError(f"Still unauthorized after {self.refreshes} consecutive relogins; giving up.")
+            self.refreshes += 1
+            label = "" if self.name == "default" else f" for {self.name}"
+            print(f"Detected expired/invalid cookies{label}. Please relogin.")
+            username, password = await asyncio.to_thread(self.source.get)
+            cookies = await login_instagram_async(username, password, login_client)
+            await asyncio.to_thread(write_cookie_json, *cookies, path=self.credentials.path)
+            self.credentials.replace(cookies)
+            print("Refreshed cookies saved.")
+
+    def succeeded(self, generation: int):
+        """A request sent with `generation`'s cookies went through: its login worked."""
+        if generation == self.credentials.generation:
+            self.refreshes = 0
+
+    def error_rate(self) -> float:
+        attempts = getattr(self.limiter, "requests", 0) or self.requests
+        errors = getattr(self.limiter, "throttled", 0) + getattr(self.limiter, "errors", 0) + self.auth_failures
+        return errors / attempts if attempts else 0.0
+
+    def report(self) -> str:
+        if not self.healthy:
+            state = f"disabled ({self.last_error})"
+        else:
+            state = "re-authenticating" if self.refreshing else "ok"
+        rate = self.limiter.report() if self.limiter is not None else f"{self.requests} requests"
+        return f"{self.name}: {state}, {self.error_rate():.1%} errors, {self.auth_failures} auth failures; {rate}"
+
+class SessionPool:
+    """
+    Several accounts behind one acquire()/release() pair.
+
+    acquire() hands out the healthy session with the fewest requests in flight
+    (each session paces itself with its own limiter). A session whose auth
+    fails is taken out of rotation while reauth() logs it in again in the
+    background; if that fails it stays disabled. acquire() waits while every
+    session is re-authenticating and raises LoginError once none is usable.
+    """
+
+    def __init__(self, sessions: List[Session]):
+        if not sessions:
+            raise ValueError("SessionPool needs at least one session.")
+        self.sessions = sessions
+        self._cond: Optional[asyncio.Condition] = None
+        self._tasks = set()
+        self._login_client = None
+
+    def _condition(self) -> asyncio.Condition:
+        # Created lazily so a pool can be built before the event loop runs.
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+        return self._cond
+
+    async def acquire(self) -> Session:
+        cond = self._condition()
+        async with cond:
+            while True:
+                ready = [s for s in self.sessions if s.healthy and not s.refreshing]
+                if ready:
+                    session = min(ready, key=lambda s: (s.in_flight, s.requests))
+                    session.in_flight += 1
+                    session.requests += 1
+                    return session
+                if not any(s.healthy for s in self.sessions):
+                    reasons = "; ".join(f"{s.name}: {s.last_error}" for s in self.sessions)
+                    raise LoginError(f"No usable sessions left ({reasons}).")
+                await cond.wait()
+
+    def release(self, session: Session):
+        session.in_flight -= 1
+
+    def reauth(self, session: Session, seen_generation: int):
+        """Start (at most one) background relogin for `session` and take it out of rotation meanwhile."""
+        if session.refreshing or not session.healthy or session.generation != seen_generation:
+            return
+        session.refreshing = True
+        METRICS.inc("instascrape_reauth_total", session=session.name)
+        task = asyncio.get_running_loop().create_task(self._reauth(session, seen_generation))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _reauth(self, session: Session, seen_generation: int):
+        # One keep-alive login client serves every relogin of the pool.
+        if self._login_client is None:
+            self._login_client = make_login_client()
+        try:
+            await session.refresh(seen_generation, self._login_client)
+        except Exception as e:
+            session.healthy = False
+            session.last_error = f"{type(e).__name__}: {e}"
+        finally:
+            session.refreshing = False
+            cond = self._condition()
+            async with cond:
+                cond.notify_all()
+
+    def prepare(self):
+        """Queue a login for every session whose stored cookies are missing or expired."""
+        for s in self.sessions:
+            try:
+                s.credentials.cookies()
+            except LoginError:
+                self.reauth(s, s.generation)
+
+    async def settle(self):
+        """Wait for the relogins in progress (e.g. those queued by prepare())."""
+        while self._tasks:
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)
+
+    async def aclose(self):
+        """Close the keep-alive login client; a later relogin opens a new one."""
+        if self._login_client is not None:
+            await self._login_client.aclose()
+            self._login_client = None
+
+    def report(self) -> List[str]:
+        return [s.report() for s in self.sessions]
+
+def load_accounts(path: str) -> Dict[str, str]:
+    """Read a JSON list of {"username", "password"} objects into {username: password}."""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            d = json.load(f)
+        if isinstance(d, dict):
+            d = [d]
+        return {a["username"]: a["password"] for a in d}
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        raise LoginError(f"Unreadable accounts file {path}: {e}")
+
+def load_session_pool(cookie_dir: str, make_limiter, accounts: Optional[Dict[str, str]] = None,
+                      only: Optional[Sequence[str]] = None) -> SessionPool:
+    """
+    One Session per stored credential set <cookie_dir>/<name>.json (same format
+    as cookie.json) and per account in `accounts`. Accounts with a password can
+    log in again on their own; the others are disabled once their cookies stop
+    working. `make_limiter()` builds each session's own rate limiter. `only`
+    restricts the pool to those names (e.g. one worker's share of the accounts).
+    """
+    accounts = accounts or {}
+    names = set(accounts)
+    if os.path.isdir(cookie_dir):
+        names.update(os.path.splitext(f)[0] for f in os.listdir(cookie_dir) if f.endswith(".json"))
+    if only is not None:
+        names &= set(only)
+    if not names:
+        raise LoginError(f"No stored sessions in {cookie_dir} and no accounts configured.")
+    os.makedirs(cookie_dir, exist_ok=True)
+    sessions = []
+    for name in sorted(names):
+        source = StaticCredentials(name, accounts[name]) if name in accounts else NoCredentials()
+        cache = CredentialCache(path=os.path.join(cookie_dir, f"{name}.json"))
+        sessions.append(Session(cache, source, limiter=make_limiter(), name=name))
+    return SessionPool(sessions)
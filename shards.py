@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+Multi-process batch runs.
+
+One event loop does all JSON decoding and output writing on a single core, so
+very large batches are split into shards, one per worker process. Each worker
+runs its own run_batch() (own client, sessions and limiters) with a share of
+the request budget and writes its reels' files itself; the parent collects the
+per-reel results, session reports and metrics into one summary. Workers
+report every finished reel over a queue, so the parent's progress bar moves per
+reel rather than per shard.
+"""
+
+import argparse
+import asyncio
+import multiprocessing
+import queue
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from math import ceil
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+from tqdm import tqdm
+
+from metrics import METRICS
+
+PROGRESS_POLL = 0.2  # seconds between checks of the workers' finished-reel queue
+
+class Shard(NamedTuple):
+    index: int
+    shortcodes: List[str]
+    rps: float
+    concurrency: int
+    accounts: Optional[List[str]]  # session names owned by this worker; None for the single cookie.json session
+    timestamp: str
+
+def partition(items: Sequence[Any], n: int) -> List[List[Any]]:
+    """Deal `items` round-robin into `n` lists."""
+    return [list(items[i::n]) for i in range(n)]
+
+def plan_shards(shortcodes: Sequence[str], workers: int, rps: float, concurrency: int,
+                accounts: Optional[Sequence[str]] = None) -> List[Shard]:
+    """
+    Split a batch over up to `workers` processes. With a single session every
+    worker gets rps / workers of its budget. With accounts each worker owns a
+    disjoint subset of them at their full per-account rps, so there are never
+    more workers than accounts. `concurrency` is divided between the workers.
+    """
+    limit = len(accounts) if accounts else workers
+    workers = max(1, min(workers, len(shortcodes) or 1, limit))
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    codes = partition(shortcodes, workers)
+    names = partition(sorted(accounts), workers) if accounts else [None] * workers
+    share = rps if accounts else rps / workers
+    per_worker = max(1, ceil(concurrency / workers))
+    return [Shard(i, codes[i], share, per_worker, names[i], timestamp) for i in range(workers)]
+
+def run_shard(shard: Shard, args: argparse.Namespace, finished=None) -> Dict[str, Any]:
+    """
+    Worker process entry point: one run_batch() over the shard on a fresh event
+    loop. The shortcode of every finished reel is put on the `finished` queue.
+    """
+    # Imported here: in the parent, main.py is usually running as __main__.
+    import main
+    main.set_output_dir(args.output_dir)
+    return asyncio.run(_run_shard(main, shard, args, finished))
+
+async def _run_shard(main, shard: Shard, args: argparse.Namespace, finished=None) -> Dict[str, Any]:
+    limiter = main.make_limiter(shard.rps, adaptive=not args.fixed_rate)
+    pool = main.pool_from_args(args, shard.rps, only=shard.accounts) if shard.accounts is not None else None
+    if pool is None:
+        source = main.credential_source(interactive=False, path=args.credentials)
+        session_tuple = main.load_or_login_get_cookies_interactive(source)
+    else:
+        source, session_tuple = None, None
+    options = main.options_from_args(args, pool)
+    try:
+        results = await main.run_batch(shard.shortcodes, session_tuple, shard.rps, shard.concurrency,
+                                       fresh=args.fresh, formats=args.formats, incremental=args.incremental,
+                                       limiter=limiter, source=source, progress=False, timestamp=shard.timestamp,
+                                       options=options,
+                                       on_done=(lambda r: finished.put(r["shortcode"])) if finished else None)
+    finally:
+        if options.cache:
+            options.cache.close()
+        if pool is not None:
+            await pool.aclose()
+    report = pool.report() if pool is not None else [limiter.report()]
+    return {"results": results, "report": report, "metrics": METRICS.export()}
+
+async def run_sharded(shards: List[Shard], args: argparse.Namespace,
+                      progress: bool = True) -> Tuple[List[Dict[str, Any]], List[str]]:
+    """
+    Run every shard in its own (spawned) process. Returns the per-reel results in
+    shard input order and one report line per session per worker. A worker that
+    dies marks all of its reels as failed; worker metrics are merged into METRICS.
+    """
+    loop = asyncio.get_running_loop()
+    done: Dict[int, Dict[str, Any]] = {}
+    ctx = multiprocessing.get_context("spawn")
+    bar = tqdm(total=sum(len(s.shortcodes) for s in shards), desc="Scraping reels", unit="reel", leave=True,
+               disable=not progress)
+
+    def tick():
+        while True:
+            try:
+                finished.get_nowait()
+            except queue.Empty:
+                return
+            bar.update(1)
+
+    async def one(executor: ProcessPoolExecutor, shard: Shard):
+        try:
+            out = await loop.run_in_executor(executor, run_shard, shard, args, finished)
+        except Exception as e:
+            error = f"worker {shard.index} failed: {type(e).__name__}: {e}"
+            out = {"results": [{"shortcode": sc, "comments": 0, "error": error, "seconds": 0.0}
+                               for sc in shard.shortcodes],
+                   "report": [error], "metrics": None}
+        if out["metrics"]:
+            METRICS.merge(out["metrics"])
+        done[shard.index] = out
+
+    async def poll(work: "asyncio.Future"):
+        while not work.done():
+            await loop.run_in_executor(None, tick)
+            await asyncio.sleep(PROGRESS_POLL)
+
+    with ctx.Manager() as manager:
+        finished = manager.Queue()
+        try:
+            with ProcessPoolExecutor(max_workers=len(shards), mp_context=ctx) as executor:
+                work = asyncio.gather(*(one(executor, s) for s in shards))
+                await asyncio.gather(work, poll(work))
+        finally:
+            # Reels of a worker that died were never reported.
+            bar.update(bar.total - bar.n)
+            bar.close()
+
+    results = [r for s in shards for r in done[s.index]["results"]]
+    reports = [f"worker {s.index}: {line}" for s in shards for line in done[s.index]["report"]]
+    return results, reports
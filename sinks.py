@@ -0,0 +1,478 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import importlib.util
+import os
+import sqlite3
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import codec
+from metrics import METRICS
+
+OUTPUT_DIR = "download_comments"
+DEFAULT_FORMATS = ("txt", "json")
+COUNT_WIDTH = 20
+ROW_GROUP_ROWS = 50000
+# Fixed row layout of the columnar and SQLite exports; replies carry their parent's id.
+ROW_COLUMNS = ("id", "shortcode", "username", "text", "created_at", "parent_id")
+SQLITE_FILE = "comments.sqlite"  # one database shared by every reel
+SQLITE_TIMEOUT = 30.0  # seconds to wait for another writer's lock
+
+def format_flat(comment: Dict[str, Any]) -> str:
+    return f"{comment.get('username', '')}: {comment.get('text', '')}"
+
+def format_txt(comment: Dict[str, Any]) -> str:
+    """The comment's "user: text" line followed by its replies, indented."""
+    replies = comment.get("replies")
+    if not replies:
+        return format_flat(comment)
+    return "\n".join([format_flat(comment)] + ["    " + format_flat(r) for r in replies])
+
+def comment_rows(comments: List[Dict[str, Any]], shortcode: str) -> Iterator[Tuple[Any, ...]]:
+    """Flatten comments and their replies into ROW_COLUMNS tuples."""
+    for c in comments:
+        cid = c.get("id")
+        yield cid, shortcode, c.get("username"), c.get("text"), c.get("created_at"), None
+        for r in c.get("replies") or ():
+            yield r.get("id"), shortcode, r.get("username"), r.get("text"), r.get("created_at"), cid
+
+def read_ndjson(path: str, chunk_size: int = 1000) -> Iterator[List[Dict[str, Any]]]:
+    """Yield the records of an NDJSON export in chunks, without loading the whole file."""
+    chunk: List[Dict[str, Any]] = []
+    with open(path, "rb") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            chunk.append(codec.loads(line))
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+    if chunk:
+        yield chunk
+
+class Sink(ABC):
+    """
+    Receives comment pages as fetch_all_pages() produces them.
+    write_page() may be called any number of times; finalize() publishes the
+    result, close() keeps partial output for a later resume, abort() discards it.
+    fetch_all_pages() awaits drain() after every page, so a sink whose consumer
+    falls behind can pause fetching.
+    """
+
+    count = 0
+    requires: Optional[str] = None  # module an optional format needs, e.g. "pyarrow"
+
+    @abstractmethod
+    def write_page(self, comments: List[Dict[str, Any]]):
+        ...
+
+    def sync(self):
+        pass
+
+    async def drain(self):
+        pass
+
+    def state(self) -> Dict[str, Any]:
+        return {}
+
+    def finalize(self) -> List[str]:
+        return []
+
+    def close(self):
+        pass
+
+    def abort(self):
+        pass
+
+class ListSink(Sink):
+    """Collects comments in memory (compactly, see codec.CommentBuffer), for library callers that want them back."""
+
+    def __init__(self):
+        self.comments = codec.CommentBuffer()
+
+    def write_page(self, comments: List[Dict[str, Any]]):
+        self.comments.extend(comments)
+        self.count = len(self.comments)
+
+class QueueSink(Sink):
+    """
+    Hands every page to an asyncio.Queue, for consumers that iterate pages as
+    they arrive. With a bounded queue, drain() blocks while it is full.
+    """
+
+    def __init__(self, queue: "asyncio.Queue[Any]"):
+        self.queue = queue
+        self._pending: "deque[List[Dict[str, Any]]]" = deque()
+
+    def write_page(self, comments: List[Dict[str, Any]]):
+        self._pending.append(comments)
+        self.count += len(comments)
+
+    async def drain(self):
+        while self._pending:
+            await self.queue.put(self._pending[0])
+            self._pending.popleft()
+
+class FileSink(Sink):
+    """
+    Streams pages into <path>.tmp and os.replace()s it over <path> on finalize,
+    so readers never see a half-written export.
+    """
+
+    def __init__(self, path: str, shortcode: str = ""):
+        self.path = path
+        self.tmp_path = path + ".tmp"
+        self.shortcode = shortcode
+        self.count = 0
+        self._fh = None
+
+    def _open(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self._fh = open(self.tmp_path, "wb")
+        self._fh.write(self._header())
+
+    def _header(self) -> bytes:
+        return b""
+
+    def _trailer(self) -> bytes:
+        return b""
+
+    @abstractmethod
+    def _encode(self, comments: List[Dict[str, Any]]) -> bytes:
+        ...
+
+    def write_page(self, comments: List[Dict[str, Any]]):
+        if self._fh is None:
+            self._open()
+        if comments:
+            self._fh.write(self._encode(comments))
+            self.count += len(comments)
+
+    def sync(self):
+        if self._fh is None:
+            self._open()
+        self._fh.flush()
+        os.fsync(self._fh.fileno())
+
+    def state(self) -> Dict[str, Any]:
+        return {"offset": self._fh.tell() if self._fh else 0, "count": self.count}
+
+    def restore(self, state: Dict[str, Any]):
+        # Anything past the committed offset is a page torn by a crash.
+        offset = int(state["offset"])
+        fh = open(self.tmp_path, "r+b")
+        fh.truncate(offset)
+        fh.seek(offset)
+        self._fh = fh
+        self.count = int(state["count"])
+
+    def _finish(self):
+        self._fh.write(self._trailer())
+
+    def finalize(self) -> List[str]:
+        if self._fh is None:
+            self._open()
+        self._finish()
+        self._fh.flush()
+        os.fsync(self._fh.fileno())
+        self._fh.close()
+        self._fh = None
+        os.replace(self.tmp_path, self.path)
+        return [self.path]
+
+    def close(self):
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+
+    def abort(self):
+        self.close()
+        try:
+            os.remove(self.tmp_path)
+        except FileNotFoundError:
+            pass
+
+class TxtSink(FileSink):
+    """One "user: text" line per comment (replies indented below), derived from the structured record."""
+
+    def _encode(self, comments: List[Dict[str, Any]]) -> bytes:
+        body = "\n".join(format_txt(c) for c in comments)
+        return (("\n" if self.count else "") + body).encode("utf-8")
+
+class NdjsonSink(FileSink):
+    """One compact JSON object per line."""
+
+    def _encode(self, comments: List[Dict[str, Any]]) -> bytes:
+        return b"".join(codec.dumps(c) + b"\n" for c in comments)
+
+class JsonSink(FileSink):
+    """
+    The {"generated_at", "count", "comments"} document, streamed as one compact
+    record per line. "count" is reserved as whitespace-padded space in the
+    header and patched in place on finalize, so the key order stays the same.
+    """
+
+    def __init__(self, path: str, shortcode: str = ""):
+        super().__init__(path, shortcode)
+        self._count_pos = 0
+
+    def _header(self) -> bytes:
+        head = f'{{"generated_at":{int(time.time())},"count":'.encode("utf-8")
+        self._count_pos = len(head)
+        return head + b" " * COUNT_WIDTH + b',"comments":[\n'
+
+    def _encode(self, comments: List[Dict[str, Any]]) -> bytes:
+        body = b",\n".join(codec.dumps(c) for c in comments)
+        return (b",\n" if self.count else b"") + body
+
+    def _trailer(self) -> bytes:
+        return b"\n]}\n" if self.count else b"]}\n"
+
+    def state(self) -> Dict[str, Any]:
+        st = super().state()
+        st["count_pos"] = self._count_pos
+        return st
+
+    def restore(self, state: Dict[str, Any]):
+        super().restore(state)
+        self._count_pos = int(state["count_pos"])
+
+    def _finish(self):
+        super()._finish()
+        end = self._fh.tell()
+        self._fh.seek(self._count_pos)
+        self._fh.write(str(self.count).ljust(COUNT_WIDTH).encode("ascii"))
+        self._fh.seek(end)
+
+class ColumnarSink(FileSink):
+    """
+    Parquet / Arrow IPC export with the fixed ROW_COLUMNS schema (needs pyarrow).
+
+    Pages are appended as compact JSON rows to a <path>.tmp spool, which
+    resumes like any other FileSink; finalize() converts the spool in
+    ROW_GROUP_ROWS chunks, so memory stays bounded by one row group.
+    """
+
+    requires = "pyarrow"
+
+    def _encode(self, comments: List[Dict[str, Any]]) -> bytes:
+        return b"".join(codec.dumps(row) + b"\n" for row in comment_rows(comments, self.shortcode))
+
+    @staticmethod
+    def schema():
+        import pyarrow as pa
+        return pa.schema([
+            ("id", pa.string()),
+            ("shortcode", pa.string()),
+            ("username", pa.string()),
+            ("text", pa.string()),
+            # Parquet has no second resolution, so both formats use milliseconds.
+            ("created_at", pa.timestamp("ms", tz="UTC")),
+            ("parent_id", pa.string()),
+        ])
+
+    @abstractmethod
+    def _writer(self, path: str, schema):
+        ...
+
+    def _table(self, rows: List[List[Any]], schema):
+        import pyarrow as pa
+        columns = list(zip(*rows)) if rows else [()] * len(ROW_COLUMNS)
+        arrays = []
+        for field, values in zip(schema, columns):
+            if field.name == "created_at":
+                values = [int(v) * 1000 if v is not None else None for v in values]
+            elif field.name in ("id", "parent_id"):
+                values = [str(v) if v is not None else None for v in values]
+            arrays.append(pa.array(values, type=field.type))
+        return pa.Table.from_arrays(arrays, schema=schema)
+
+    def finalize(self) -> List[str]:
+        if self._fh is None:
+            self._open()
+        self._fh.flush()
+        self._fh.close()
+        self._fh = None
+        schema = self.schema()
+        out_tmp = self.path + ".out"
+        writer = self._writer(out_tmp, schema)
+        try:
+            wrote = False
+            for rows in read_ndjson(self.tmp_path, ROW_GROUP_ROWS):
+                writer.write_table(self._table(rows, schema))
+                wrote = True
+            if not wrote:
+                writer.write_table(self._table([], schema))
+        finally:
+            writer.close()
+        with open(out_tmp, "rb") as f:
+            os.fsync(f.fileno())
+        os.replace(out_tmp, self.path)
+        os.remove(self.tmp_path)
+        return [self.path]
+
+class ParquetSink(ColumnarSink):
+    def _writer(self, path: str, schema):
+        import pyarrow.parquet as pq
+        return pq.ParquetWriter(path, schema, compression="zstd")
+
+class ArrowSink(ColumnarSink):
+    def _writer(self, path: str, schema):
+        import pyarrow as pa
+        return pa.ipc.new_file(path, schema)
+
+class SqliteSink(Sink):
+    """
+    Upserts every reel's rows into one shared `comments` table, keyed by
+    comment id, so re-scraping or refreshing a reel never duplicates rows.
+    Each page is committed as it is written; a resumed or aborted run leaves
+    its rows in place since they are real comments and the next run upserts
+    them again. finalize() only closes the connection.
+    """
+
+    def __init__(self, path: str, shortcode: str = ""):
+        self.path = path
+        self.shortcode = shortcode
+        self.count = 0
+        self._db: Optional[sqlite3.Connection] = None
+
+    def _open(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        # Batch workers and shard processes write to the same file.
+        self._db = sqlite3.connect(self.path, timeout=SQLITE_TIMEOUT)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        with self._db:
+            self._db.execute("CREATE TABLE IF NOT EXISTS comments (id TEXT PRIMARY KEY, shortcode TEXT, "
+                             "username TEXT, text TEXT, created_at INTEGER, parent_id TEXT)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS idx_comments_shortcode ON comments (shortcode)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS idx_comments_created_at ON comments (created_at)")
+
+    def write_page(self, comments: List[Dict[str, Any]]):
+        if self._db is None:
+            self._open()
+        if comments:
+            # Committed right away: an open write transaction would lock out the other reels.
+            with self._db:
+                self._db.executemany(
+                    "INSERT INTO comments VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (id) DO UPDATE SET "
+                    "shortcode = excluded.shortcode, username = excluded.username, text = excluded.text, "
+                    "created_at = excluded.created_at, parent_id = excluded.parent_id",
+                    comment_rows(comments, self.shortcode))
+            self.count += len(comments)
+
+    def state(self) -> Dict[str, Any]:
+        return {"count": self.count}
+
+    def restore(self, state: Dict[str, Any]):
+        self.count = int(state["count"])
+
+    def finalize(self) -> List[str]:
+        if self._db is None:
+            self._open()
+        self.close()
+        return [self.path]
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def abort(self):
+        self.close()
+
+FILE_SINKS = {
+    "txt": TxtSink,
+    "json": JsonSink,
+    "ndjson": NdjsonSink,
+    "parquet": ParquetSink,
+    "arrow": ArrowSink,
+    "sqlite": SqliteSink,
+}
+
+def set_output_dir(path: str):
+    """Root every export (and, via output_dir(), the checkpoints and index) at `path`."""
+    global OUTPUT_DIR
+    OUTPUT_DIR = path
+
+def output_dir(*parts: str) -> str:
+    return os.path.join(OUTPUT_DIR, *parts)
+
+def output_path(base_name: str, fmt: str) -> str:
+    if fmt == "sqlite":
+        return os.path.join(OUTPUT_DIR, fmt, SQLITE_FILE)
+    return os.path.join(OUTPUT_DIR, fmt, f"{base_name}.{fmt}")
+
+def missing_dependencies(formats: Sequence[str]) -> Dict[str, str]:
+    """{format: module} for requested formats whose optional dependency is not installed."""
+    missing = {}
+    for fmt in formats:
+        req = getattr(FILE_SINKS.get(fmt), "requires", None)
+        if req and importlib.util.find_spec(req) is None:
+            missing[fmt] = req
+    return missing
+
+class MultiSink(Sink):
+    """
+    Fans each page out to one sink per format under OUTPUT_DIR/<format>/.
+    `shortcode` fills the shortcode column of the row-based formats.
+    """
+
+    def __init__(self, base_name: str, formats: Sequence[str] = DEFAULT_FORMATS, shortcode: str = ""):
+        unknown = [f for f in formats if f not in FILE_SINKS]
+        if unknown:
+            raise ValueError(f"Unknown output format(s): {', '.join(unknown)}")
+        missing = missing_dependencies(formats)
+        if missing:
+            raise ValueError("Output format(s) need extra packages: "
+                             + ", ".join(f"{fmt} (pip install {mod})" for fmt, mod in missing.items()))
+        self.base_name = base_name
+        self.shortcode = shortcode
+        self.sinks: Dict[str, Sink] = {fmt: FILE_SINKS[fmt](output_path(base_name, fmt), shortcode)
+                                       for fmt in formats}
+
+    @property
+    def count(self) -> int:
+        return max((s.count for s in self.sinks.values()), default=0)
+
+    def write_page(self, comments: List[Dict[str, Any]]):
+        for fmt, s in self.sinks.items():
+            with METRICS.timer("instascrape_sink_write_seconds", format=fmt):
+                s.write_page(comments)
+
+    def sync(self):
+        for fmt, s in self.sinks.items():
+            with METRICS.timer("instascrape_sink_sync_seconds", format=fmt):
+                s.sync()
+
+    def state(self) -> Dict[str, Any]:
+        return {"base_name": self.base_name, "shortcode": self.shortcode,
+                "files": {fmt: s.state() for fmt, s in self.sinks.items()}}
+
+    @classmethod
+    def restore(cls, state: Dict[str, Any]) -> "MultiSink":
+        files = state["files"]
+        multi = cls(state["base_name"], list(files), state.get("shortcode", ""))
+        try:
+            for fmt, s in multi.sinks.items():
+                s.restore(files[fmt])
+        except Exception:
+            multi.close()
+            raise
+        return multi
+
+    def finalize(self) -> List[str]:
+        paths: List[str] = []
+        for s in self.sinks.values():
+            paths.extend(s.finalize())
+        return paths
+
+    def close(self):
+        for s in self.sinks.values():
+            s.close()
+
+    def abort(self):
+        for s in self.sinks.values():
+            s.abort()
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+Shared fixtures for the tests: a MockTransport stand-in for one reel's parent
+comment pages, a single-session pool whose cookie file lives in a temporary
+directory, and a TestCase that writes all output there too.
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+import main
+import sinks
+from session import CredentialCache, CredentialSource, NoCredentials, Session, SessionPool
+
+SESSION = ("sid", "csrf", "mid", "42")
+BASE_URL = "http://reels"
+
+def make_comments(n: int, first_id: int = 1000, newest: int = 1700000000,
+                  usernames=("alice", "bob")) -> List[Dict[str, Any]]:
+    """`n` comment records, newest first, with numeric ids counting down from first_id + n - 1."""
+    return [{"id": str(first_id + n - 1 - i), "username": usernames[i % len(usernames)],
+             "text": f"comment {first_id + n - 1 - i}", "created_at": newest - i} for i in range(n)]
+
+def parent_page(comments: List[Dict[str, Any]], count: int, end_cursor: Optional[str]) -> Dict[str, Any]:
+    edges = [{"node": {"id": c["id"], "text": c["text"], "owner": {"username": c["username"]},
+                       "created_at": c["created_at"]}} for c in comments]
+    return {"data": {"shortcode_media": {"edge_media_to_parent_comment": {
+        "count": count, "edges": edges,
+        "page_info": {"has_next_page": end_cursor is not None, "end_cursor": end_cursor}}}}}
+
+class ReelServer:
+    """
+    MockTransport handler paging through `comments` (newest first), `per_page`
+    at a time, with the offset as cursor. Raises at the page starting at
+    `crash_at`, like a process dying mid-run.
+    """
+
+    def __init__(self, comments: List[Dict[str, Any]], per_page: int = 5):
+        self.comments = comments
+        self.per_page = per_page
+        self.crash_at: Optional[int] = None
+        self.requests = 0
+
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        self.requests += 1
+        offset = int(json.loads(request.url.params["variables"]).get("after") or 0)
+        if offset == self.crash_at:
+            raise RuntimeError("simulated crash")
+        page = self.comments[offset:offset + self.per_page]
+        end = offset + len(page)
+        return httpx.Response(200, json=parent_page(page, len(self.comments),
+                                                    str(end) if end < len(self.comments) else None))
+
+    def client(self) -> httpx.AsyncClient:
+        return httpx.AsyncClient(transport=httpx.MockTransport(self), base_url=BASE_URL)
+
+def make_session(directory: str, name: str = "default", source: Optional[CredentialSource] = None,
+                 fallback=SESSION, rps: float = 1000.0) -> Session:
+    credentials = CredentialCache(fallback=fallback, path=os.path.join(directory, f"{name}.json"))
+    return Session(credentials, source or NoCredentials(), limiter=main.RateLimiter(rps), name=name)
+
+def make_pool(directory: str) -> SessionPool:
+    return SessionPool([make_session(directory)])
+
+class OutputDirTestCase(unittest.TestCase):
+    """Runs every test with the exports, checkpoints and index under a fresh temporary directory."""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.previous_output_dir = sinks.OUTPUT_DIR
+        sinks.set_output_dir(os.path.join(self.dir, "out"))
+
+    def tearDown(self):
+        sinks.set_output_dir(self.previous_output_dir)
+        shutil.rmtree(self.dir, ignore_errors=True)
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+ResponseCache: TTL expiry, least-recently-used eviction and conditional
+revalidation (ETag / HTTP 304) through limited_request().
+
+Run from the repository root: python -m unittest discover tests
+"""
+
+import asyncio
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import httpx
+
+import codec
+import main
+from cache import ResponseCache, cache_key
+from reel_server import BASE_URL, make_comments, parent_page
+
+VARIABLES = {"shortcode": "REEL", "first": 50}
+
+class CacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        # Cleanups run last in, first out: every cache is closed before the directory goes.
+        self.addCleanup(shutil.rmtree, self.dir, True)
+
+    def open_cache(self, **kwargs) -> ResponseCache:
+        cache = ResponseCache(os.path.join(self.dir, "cache.sqlite"), **kwargs)
+        self.addCleanup(cache.close)
+        return cache
+
+class ResponseCacheTest(CacheTestCase):
+    def test_expired_entries_without_validators_are_dropped(self):
+        cache = self.open_cache(ttl=0.05)
+        cache.put("plain", b"body")
+        cache.put("tagged", b"body", etag='"v1"')
+        self.assertTrue(cache.get("plain").fresh)
+
+        time.sleep(0.1)
+        self.assertIsNone(cache.get("plain"))
+        stale = cache.get("tagged")
+        self.assertFalse(stale.fresh)
+        self.assertEqual(stale.validators(), {"If-None-Match": '"v1"'})
+
+    def test_least_recently_used_entries_are_evicted_first(self):
+        cache = self.open_cache(max_bytes=250)
+        cache.put("a", b"a" * 100)
+        time.sleep(0.01)
+        cache.put("b", b"b" * 100)
+        time.sleep(0.01)
+        cache.get("a")
+        time.sleep(0.01)
+        cache.put("c", b"c" * 100)
+
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a").body, b"a" * 100)
+        self.assertEqual(cache.get("c").body, b"c" * 100)
+
+    def test_bypass_misses_but_still_stores(self):
+        self.open_cache(bypass=True).put("k", b"body")
+        self.assertIsNone(self.open_cache(bypass=True).get("k"))
+        self.assertEqual(self.open_cache().get("k").body, b"body")
+
+class ETagServer:
+    """Serves one page with an ETag and answers 304 to a request that already holds it."""
+
+    def __init__(self):
+        self.requests = []
+
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        self.requests.append(request)
+        if request.headers.get("If-None-Match") == '"v1"':
+            return httpx.Response(304, headers={"ETag": '"v1"'})
+        return httpx.Response(200, json=parent_page(make_comments(3), 3, None), headers={"ETag": '"v1"'})
+
+class RevalidationTest(CacheTestCase):
+    def fetch(self, server: ETagServer, cache: ResponseCache) -> codec.ParentPage:
+        async def run():
+            async with httpx.AsyncClient(transport=httpx.MockTransport(server), base_url=BASE_URL) as client:
+                return await main.limited_request(client, main.RateLimiter(1000), main.PARENT_QUERY_HASH, VARIABLES,
+                                                  decode=codec.decode_parent_page, cache=cache)
+        return asyncio.run(run())
+
+    def test_stale_entry_is_revalidated_with_its_etag(self):
+        server = ETagServer()
+        cache = self.open_cache(ttl=0)
+        first = self.fetch(server, cache)
+        second = self.fetch(server, cache)
+
+        self.assertEqual(len(server.requests), 2)
+        self.assertIsNone(server.requests[0].headers.get("If-None-Match"))
+        self.assertEqual(server.requests[1].headers.get("If-None-Match"), '"v1"')
+        self.assertEqual([c.to_dict() for c in second.comments], [c.to_dict() for c in first.comments])
+
+    def test_revalidation_restarts_the_ttl(self):
+        server = ETagServer()
+        cache = self.open_cache(ttl=0)
+        self.fetch(server, cache)
+        cache.ttl = 60
+        self.fetch(server, cache)
+        self.assertTrue(cache.get(cache_key(main.PARENT_QUERY_HASH, VARIABLES)).fresh)
+
+        self.fetch(server, cache)
+        self.assertEqual(len(server.requests), 2)
+
+if __name__ == "__main__":
+    unittest.main()
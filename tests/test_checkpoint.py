@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+Checkpointed scrapes: a crashed run resumes from its last committed page, and
+partial export files are cut back to what the checkpoint knows about.
+
+Run from the repository root: python -m unittest discover tests
+"""
+
+import asyncio
+import json
+import os
+import unittest
+
+import main
+import sinks
+from reel_server import SESSION, OutputDirTestCase, ReelServer, make_comments, make_pool
+
+def read_json_export(path: str) -> dict:
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+class ResumeTest(OutputDirTestCase):
+    formats = ("json", "ndjson", "txt")
+
+    def scrape(self, server: ReelServer, fresh: bool = False):
+        async def run():
+            async with server.client() as client:
+                return await main.scrape_reel("REEL", SESSION, 1000, "reel_comments_REEL", self.formats,
+                                              client=client, progress=False, fresh=fresh,
+                                              options=main.ScrapeOptions(pool=make_pool(self.dir)))
+        return asyncio.run(run())
+
+    def test_crashed_run_resumes_from_its_last_committed_page(self):
+        comments = make_comments(23)
+        server = ReelServer(comments, per_page=5)
+        server.crash_at = 15
+        with self.assertRaises(RuntimeError):
+            self.scrape(server)
+
+        state = main.Checkpoint("REEL").load()
+        self.assertEqual(state["count"], 15)
+        self.assertEqual(state["end_cursor"], "15")
+
+        server.crash_at = None
+        requests = server.requests
+        count, paths = self.scrape(server)
+
+        self.assertEqual(count, 23)
+        # Only the pages after the checkpoint are fetched again.
+        self.assertEqual(server.requests - requests, 2)
+        self.assertIsNone(main.Checkpoint("REEL").load())
+        doc = read_json_export(sinks.output_path("reel_comments_REEL", "json"))
+        self.assertEqual(doc["count"], 23)
+        self.assertEqual([c["id"] for c in doc["comments"]], [c["id"] for c in comments])
+        ndjson = [c for chunk in sinks.read_ndjson(sinks.output_path("reel_comments_REEL", "ndjson")) for c in chunk]
+        self.assertEqual(ndjson, comments)
+        with open(sinks.output_path("reel_comments_REEL", "txt"), "r", encoding="utf-8") as f:
+            self.assertEqual(len(f.read().splitlines()), 23)
+
+    def test_fresh_discards_the_partial_run(self):
+        server = ReelServer(make_comments(12), per_page=5)
+        server.crash_at = 10
+        with self.assertRaises(RuntimeError):
+            self.scrape(server)
+        server.crash_at = None
+        requests = server.requests
+        count, _ = self.scrape(server, fresh=True)
+
+        self.assertEqual(count, 12)
+        self.assertEqual(server.requests - requests, 3)
+        self.assertEqual(read_json_export(sinks.output_path("reel_comments_REEL", "json"))["count"], 12)
+
+class FileSinkRestoreTest(OutputDirTestCase):
+    def test_restore_truncates_a_page_written_after_the_last_commit(self):
+        path = os.path.join(self.dir, "out", "reel.json")
+        first, torn, after = make_comments(3, 100), make_comments(2, 200), make_comments(4, 300)
+        sink = sinks.JsonSink(path)
+        sink.write_page(first)
+        sink.sync()
+        state = sink.state()
+        sink.write_page(torn)
+        sink.close()
+
+        resumed = sinks.JsonSink(path)
+        resumed.restore(state)
+        resumed.write_page(after)
+        resumed.finalize()
+
+        doc = read_json_export(path)
+        self.assertEqual(list(doc), ["generated_at", "count", "comments"])
+        self.assertEqual(doc["count"], 7)
+        self.assertEqual(doc["comments"], first + after)
+        self.assertFalse(os.path.exists(path + ".tmp"))
+
+    def test_json_count_is_patched_in_place(self):
+        path = os.path.join(self.dir, "out", "reel.json")
+        sink = sinks.JsonSink(path)
+        for start in (0, 50, 100):
+            sink.write_page(make_comments(50, 1000 + start))
+        sink.finalize()
+        self.assertEqual(read_json_export(path)["count"], 150)
+
+        empty = os.path.join(self.dir, "out", "empty.json")
+        sinks.JsonSink(empty).finalize()
+        doc = read_json_export(empty)
+        self.assertEqual((doc["count"], doc["comments"]), (0, []))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+codec: every installed JSON backend decodes pages the same way, and
+CommentBuffer gives back exactly what was stored.
+
+Run from the repository root: python -m unittest discover tests
+"""
+
+import json
+import unittest
+
+import codec
+
+def node(cid, username, text, created_at, thread=None) -> dict:
+    n = {"id": cid, "text": text, "owner": {"username": username}, "created_at": created_at}
+    if thread is not None:
+        n["edge_threaded_comments"] = thread
+    return n
+
+PARENT = json.dumps({"data": {"shortcode_media": {"edge_media_to_parent_comment": {
+    "count": 3,
+    "page_info": {"has_next_page": True, "end_cursor": "QVFE"},
+    "edges": [
+        {"node": node("1790001", "alice", "first ✨ comment", 1700000300, {
+            "count": 3, "page_info": {"has_next_page": True, "end_cursor": "R1"},
+            "edges": [{"node": node("1790011", "bob", "reply", 1700000310)}]})},
+        {"node": node("1790002", "bob", "with \"quotes\" and \\ slashes", 1700000200,
+                      {"count": 2, "page_info": {"has_next_page": False, "end_cursor": None}, "edges": []})},
+        {"node": node("1790003", "carol", "", 1700000100, {"count": 0, "edges": []})},
+    ]}}}}, ensure_ascii=False).encode("utf-8")
+
+CHILD = json.dumps({"data": {"comment": {"edge_threaded_comments": {
+    "page_info": {"has_next_page": False, "end_cursor": None},
+    "edges": [{"node": node("1790012", "dave", "later reply", 1700000400)}]}}}}).encode("utf-8")
+
+def parent_view(page: codec.ParentPage):
+    threads = {k: ([c.to_dict() for c in inline], more, cursor) for k, (inline, more, cursor) in page.threads.items()}
+    return page.count, page.has_next, page.end_cursor, [c.to_dict() for c in page.comments], threads
+
+def child_view(page: codec.ChildPage):
+    return page.has_next, page.end_cursor, [c.to_dict() for c in page.comments]
+
+class BackendParityTest(unittest.TestCase):
+    def setUp(self):
+        self.previous = codec.BACKEND
+
+    def tearDown(self):
+        codec.use(self.previous)
+
+    def decode_all(self, name: str):
+        codec.use(name)
+        return (parent_view(codec.decode_parent_page(PARENT)), parent_view(codec.decode_parent_page(PARENT, True)),
+                child_view(codec.decode_child_page(CHILD)))
+
+    def test_backends_decode_pages_identically(self):
+        expected = self.decode_all("json")
+        self.assertEqual(expected[1][4], {
+            "1790001": ([{"id": "1790011", "username": "bob", "text": "reply", "created_at": 1700000310}], True, "R1"),
+            "1790002": ([], True, None),
+        })
+        for name in codec.available_backends():
+            with self.subTest(backend=name):
+                self.assertEqual(self.decode_all(name), expected)
+
+    def test_backends_reject_pages_of_the_wrong_shape(self):
+        for name in codec.available_backends():
+            codec.use(name)
+            with self.subTest(backend=name):
+                with self.assertRaises(codec.ShapeError):
+                    codec.decode_parent_page(b'{"data": {"shortcode_media": null}}')
+                with self.assertRaises(codec.ShapeError):
+                    codec.decode_child_page(b'{"data": {}}')
+
+    def test_dumps_round_trips_comments_on_every_backend(self):
+        comment = codec.Comment("1790001", "alice", "héllo ✨", 1700000000,
+                                [codec.Comment("1790002", "bob", "reply", 1700000001)])
+        for name in codec.available_backends():
+            codec.use(name)
+            with self.subTest(backend=name):
+                self.assertEqual(json.loads(codec.dumps(comment)), comment.to_dict())
+                self.assertEqual(codec.loads(codec.dumps([comment])), [comment.to_dict()])
+
+class CommentBufferTest(unittest.TestCase):
+    RECORDS = [
+        {"id": "17900000000000001", "username": "alice", "text": "numeric id", "created_at": 1700000000},
+        {"id": "0", "username": "bob", "text": "zero", "created_at": 0},
+        {"id": "007", "username": "bob", "text": "leading zero", "created_at": -5},
+        {"id": "abc", "username": "carol", "text": "not numeric", "created_at": None},
+        {"id": None, "username": "", "text": "", "created_at": 1.5},
+        {"id": "9" * 19, "username": "dave", "text": "too long for int64", "created_at": 2 ** 63},
+        {"id": "1", "username": "alice", "text": "with replies", "created_at": 1,
+         "replies": [{"id": "2", "username": "bob", "text": "r", "created_at": 2}]},
+    ]
+
+    def test_round_trip_keeps_ids_and_created_at(self):
+        buffer = codec.CommentBuffer(chunk_rows=3)
+        buffer.extend(self.RECORDS)
+
+        self.assertEqual(len(buffer), len(self.RECORDS))
+        self.assertEqual([c.to_dict() for c in buffer], self.RECORDS)
+        self.assertEqual([type(c.id) for c in buffer if c.id is not None], [str] * 6)
+        self.assertEqual(buffer[-1].to_dict(), self.RECORDS[-1])
+        self.assertEqual([c.to_dict() for c in buffer[2:5]], self.RECORDS[2:5])
+        self.assertEqual([len(page) for page in buffer.pages()], [3, 3, 1])
+
+    def test_comments_and_dicts_are_interchangeable(self):
+        buffer = codec.CommentBuffer()
+        buffer.extend(codec.Comment(r["id"], r["username"], r["text"], r["created_at"]) for r in self.RECORDS[:4])
+        self.assertEqual([c.to_dict() for c in buffer], self.RECORDS[:4])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+Incremental refreshes: the SeenIndex, early stops under --match/--user and
+--since, and recovery from a run that died before saving its index.
+
+Run from the repository root: python -m unittest discover tests
+"""
+
+import asyncio
+import os
+import time
+import unittest
+from unittest import mock
+
+import main
+import sinks
+from reel_server import SESSION, OutputDirTestCase, ReelServer, make_comments, make_pool
+
+# Pages the prefetcher may have queued or in flight when pagination stops.
+PREFETCH_BOUND = main.PREFETCH_PAGES + 1
+
+def exported_ids(shortcode: str = "REEL"):
+    path = sinks.output_path(f"reel_comments_{shortcode}", "ndjson")
+    return [c["id"] for chunk in sinks.read_ndjson(path) for c in chunk]
+
+class SeenIndexTest(OutputDirTestCase):
+    def test_known_pages_and_new_comments(self):
+        index = main.SeenIndex("REEL")
+        page = make_comments(3)
+        self.assertEqual(index.add_new(page), page)
+        self.assertEqual(index.add_new(page + make_comments(1, 2000)), make_comments(1, 2000))
+        self.assertEqual(index.newest_created_at, 1700000000)
+        self.assertTrue(index.known(page))
+        self.assertFalse(index.known([]))
+        self.assertFalse(index.known(page + make_comments(1, 3000)))
+
+    def test_examined_ids_only_count_under_the_same_filter(self):
+        index = main.SeenIndex("REEL")
+        index.use_filter('{"users":["alice"]}')
+        page = make_comments(4)
+        index.add_new([c for c in page if c["username"] == "alice"])
+        index.examine(page)
+        self.assertTrue(index.known(page))
+        index.save()
+
+        same = main.SeenIndex("REEL")
+        self.assertTrue(same.load())
+        same.use_filter('{"users":["alice"]}')
+        self.assertTrue(same.known(page))
+
+        unfiltered = main.SeenIndex("REEL")
+        unfiltered.load()
+        unfiltered.use_filter(None)
+        self.assertFalse(unfiltered.known(page))
+        unfiltered.examine(page)
+        self.assertEqual(unfiltered.examined, set())
+
+class RefreshTest(OutputDirTestCase):
+    def refresh(self, server: ReelServer, comment_filter=None):
+        async def run():
+            async with server.client() as client:
+                options = main.ScrapeOptions(pool=make_pool(self.dir), comment_filter=comment_filter)
+                return await main.refresh_reel("REEL", SESSION, 1000, ("json",), client=client, progress=False,
+                                               options=options)
+        return asyncio.run(run())
+
+    def test_refresh_stops_at_the_first_known_page(self):
+        comments = make_comments(60, 100)
+        server = ReelServer(comments, per_page=5)
+        self.assertEqual(self.refresh(server)[0], 60)
+
+        comments[:0] = make_comments(3, 200)
+        server.requests = 0
+        self.assertEqual(self.refresh(server)[0], 3)
+        # The known second page ends it; only pages already prefetched by then are wasted.
+        self.assertLessEqual(server.requests, 2 + PREFETCH_BOUND)
+        self.assertEqual(exported_ids(), [c["id"] for c in comments])
+
+        server.requests = 0
+        self.assertEqual(self.refresh(server), (0, []))
+        self.assertEqual(server.requests, 1)
+
+    def test_filtered_refresh_still_stops_early(self):
+        comments = make_comments(12)
+        server = ReelServer(comments, per_page=5)
+        alice = main.CommentFilter(usernames=["alice"])
+        self.assertEqual(self.refresh(server, alice)[0], 6)
+
+        server.requests = 0
+        self.assertEqual(self.refresh(server, alice)[0], 0)
+        self.assertEqual(server.requests, 1)
+
+        # Without the filter, the comments it dropped are fetched and exported.
+        self.assertEqual(self.refresh(server)[0], 6)
+        self.assertEqual(sorted(exported_ids()), sorted(c["id"] for c in comments))
+
+    def test_since_stops_on_the_page_that_reaches_past_it(self):
+        comments = make_comments(60)
+        server = ReelServer(comments, per_page=5)
+        since = main.CommentFilter(since=comments[7]["created_at"])
+        self.assertEqual(self.refresh(server, since)[0], 8)
+        self.assertLessEqual(server.requests, 2 + PREFETCH_BOUND)
+
+    def test_index_older_than_the_export_is_caught_up(self):
+        comments = make_comments(12, 100)
+        server = ReelServer(comments, per_page=5)
+        self.refresh(server)
+        index_path = main.SeenIndex("REEL").path
+        stamp = time.time() - 60
+        os.utime(index_path, (stamp, stamp))
+
+        comments[:0] = make_comments(3, 200)
+        with mock.patch.object(main.SeenIndex, "save", side_effect=RuntimeError("crash before saving the index")):
+            with self.assertRaises(RuntimeError):
+                self.refresh(server)
+
+        self.assertEqual(self.refresh(server), (0, []))
+        self.assertEqual(exported_ids(), [c["id"] for c in comments])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+AdaptiveRateLimiter against a scripted stand-in for /graphql/query/.
+
+Run from the repository root: python -m unittest discover tests
+"""
+
+import asyncio
+import time
+import unittest
+
+import httpx
+
+import codec
+import main
+
+def page_body() -> dict:
+    edges = [{"node": {"id": "1", "text": "hi", "owner": {"username": "u"}, "created_at": 1700000000}}]
+    return {"data": {"shortcode_media": {"edge_media_to_parent_comment": {
+        "count": 1, "edges": edges, "page_info": {"has_next_page": False, "end_cursor": None}}}}}
+
+class ScriptedServer:
+    """MockTransport handler answering with the scripted (status, headers) pairs first, then 200 pages."""
+
+    def __init__(self, script):
+        self.script = list(script)
+        self.times = []
+
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        self.times.append(time.perf_counter())
+        if self.script:
+            status, headers = self.script.pop(0)
+            return httpx.Response(status, headers=headers, text="scripted")
+        return httpx.Response(200, json=page_body())
+
+class SteppedLatencyServer:
+    """Answers every request with a 200 page after `before` seconds, or `after` seconds from request `step` on."""
+
+    def __init__(self, step: int, before: float, after: float):
+        self.step = step
+        self.before = before
+        self.after = after
+        self.requests = 0
+
+    async def __call__(self, request: httpx.Request) -> httpx.Response:
+        self.requests += 1
+        await asyncio.sleep(self.before if self.requests < self.step else self.after)
+        return httpx.Response(200, json=page_body())
+
+async def run_requests(server: ScriptedServer, limiter: main.RateLimiter, n: int):
+    """n limited_request() calls in a row; returns the limiter's rate after each."""
+    rates = []
+    async with httpx.AsyncClient(transport=httpx.MockTransport(server), base_url="http://scripted") as client:
+        for _ in range(n):
+            await main.limited_request(client, limiter, main.PARENT_QUERY_HASH, {"shortcode": "SC", "first": 1},
+                                       decode=codec.decode_parent_page)
+            rates.append(limiter.rps)
+    return rates
+
+class AdaptiveRateLimiterTest(unittest.TestCase):
+    def test_429_halves_rate_honours_retry_after_and_ramps_back(self):
+        server = ScriptedServer([(429, {"Retry-After": "0.5"})])
+        # A fast ramp and no latency cuts keep the run short and deterministic.
+        limiter = main.AdaptiveRateLimiter(20, increase=20, latency_factor=1e9)
+        rates = asyncio.run(run_requests(server, limiter, 12))
+
+        self.assertEqual(limiter.throttled, 1)
+        self.assertGreaterEqual(server.times[1] - server.times[0], 0.5)
+        self.assertLess(rates[0], 20)
+        self.assertGreaterEqual(rates[0], 10 - 1e-9)
+        self.assertEqual(rates[-1], 20)
+        self.assertEqual(rates, sorted(rates))
+
+    def test_rate_is_halved_once_per_burst_of_429s(self):
+        server = ScriptedServer([(429, {"Retry-After": "0"})] * 2)
+        limiter = main.AdaptiveRateLimiter(20, increase=0.0001, latency_factor=1e9)
+        asyncio.run(run_requests(server, limiter, 1))
+
+        self.assertEqual(limiter.throttled, 2)
+        self.assertAlmostEqual(limiter.rps, 10, places=2)
+
+    def test_lasting_latency_step_becomes_the_new_baseline(self):
+        server = SteppedLatencyServer(step=10, before=0.01, after=0.04)
+        limiter = main.AdaptiveRateLimiter(50, increase=50)
+        rates = asyncio.run(run_requests(server, limiter, 40))
+
+        # The step may cost a cut or two, but not one per second for the rest of the run.
+        self.assertGreaterEqual(min(rates), 50 * 0.9 ** 2 - 1e-9)
+        self.assertEqual(rates[-1], 50)
+        self.assertGreater(limiter._baseline, 0.02)
+
+    def test_client_errors_are_not_retried(self):
+        server = ScriptedServer([(404, {})])
+        limiter = main.AdaptiveRateLimiter(20)
+        with self.assertRaises(main.ScrapeError):
+            asyncio.run(run_requests(server, limiter, 1))
+        self.assertEqual(len(server.times), 1)
+        self.assertEqual(limiter.throttled + limiter.errors, 0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+Sessions and the SessionPool: one relogin however many requests hit an
+expired session at once, accounts that cannot log in leave the rotation, and
+an account that keeps failing right after logging in gives up.
+
+Run from the repository root: python -m unittest discover tests
+"""
+
+import asyncio
+import io
+import json
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import httpx
+
+import codec
+import login
+import main
+from login import LoginError
+from reel_server import BASE_URL, make_comments, make_session, parent_page
+from session import SessionPool, StaticCredentials
+
+class LoginServer:
+    """MockTransport stand-in for the prelogin and login endpoints; logs every user in as sessionid=S-<username>."""
+
+    def __init__(self):
+        self.logins = []
+
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        if request.url.path.endswith("si/fetch_headers/"):
+            return httpx.Response(200, headers=[("Set-Cookie", "csrftoken=pre; Domain=.instagram.com; Max-Age=3600"),
+                                                ("Set-Cookie", "mid=M1; Domain=.instagram.com; Max-Age=3600")])
+        body = httpx.QueryParams(request.content.decode())["signed_body"].split(".", 1)[1]
+        username = json.loads(body)["username"]
+        self.logins.append(username)
+        return httpx.Response(200, json={"logged_in_user": {"pk": 1}}, headers=[
+            ("Set-Cookie", f"sessionid=S-{username}; Domain=.instagram.com; Max-Age=7200"),
+            ("Set-Cookie", "csrftoken=post; Domain=.instagram.com; Max-Age=7200"),
+            ("Set-Cookie", f"ds_user_id=D-{username}; Domain=.instagram.com; Max-Age=7200")])
+
+class AuthServer:
+    """GraphQL stand-in answering 401 unless the Cookie header carries one of the `accepted` session ids."""
+
+    def __init__(self, accepted):
+        self.accepted = set(accepted)
+        self.unauthorized = 0
+
+    async def __call__(self, request: httpx.Request) -> httpx.Response:
+        cookies = dict(part.split("=", 1) for part in request.headers["Cookie"].split("; "))
+        # Yield so concurrent requests all go out before any relogin finishes.
+        await asyncio.sleep(0.01)
+        if cookies["sessionid"] not in self.accepted:
+            self.unauthorized += 1
+            return httpx.Response(401)
+        return httpx.Response(200, json=parent_page(make_comments(2), 2, None))
+
+class SessionPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir, True)
+        self.login_server = LoginServer()
+        # The relogin messages are expected here; keep them out of the test output.
+        quiet = mock.patch("sys.stdout", new_callable=io.StringIO)
+        quiet.start()
+        self.addCleanup(quiet.stop)
+
+    def run_requests(self, pool: SessionPool, server: AuthServer, n: int):
+        async def run():
+            options = {k: v for k, v in login.login_client_options().items() if k != "http2"}
+            pool._login_client = httpx.AsyncClient(transport=httpx.MockTransport(self.login_server), **options)
+            try:
+                async with httpx.AsyncClient(transport=httpx.MockTransport(server), base_url=BASE_URL) as client:
+                    return await asyncio.gather(*(
+                        main.pool_request(client, pool, f"REEL{i}", main.PARENT_QUERY_HASH,
+                                          {"shortcode": f"REEL{i}", "first": 50}, codec.decode_parent_page)
+                        for i in range(n)), return_exceptions=True)
+            finally:
+                await pool.aclose()
+        return asyncio.run(run())
+
+    def test_concurrent_auth_failures_share_one_relogin(self):
+        alice = make_session(self.dir, "alice", StaticCredentials("alice", "pw"), fallback=("expired", "c", "m", "d"))
+        server = AuthServer(accepted={"S-alice"})
+        results = self.run_requests(SessionPool([alice]), server, 5)
+
+        self.assertTrue(all(isinstance(r, codec.ParentPage) for r in results), results)
+        self.assertEqual(self.login_server.logins, ["alice"])
+        self.assertGreater(server.unauthorized, 1)
+        self.assertEqual(alice.refreshes, 0)
+        self.assertTrue(alice.healthy)
+
+    def test_session_that_cannot_log_in_leaves_the_rotation(self):
+        alice = make_session(self.dir, "alice", fallback=("S-alice", "c", "m", "d"))
+        bob = make_session(self.dir, "bob", fallback=("expired", "c", "m", "d"))
+        server = AuthServer(accepted={"S-alice"})
+        results = self.run_requests(SessionPool([alice, bob]), server, 6)
+
+        self.assertTrue(all(isinstance(r, codec.ParentPage) for r in results), results)
+        self.assertFalse(bob.healthy)
+        self.assertIn("LoginError", bob.last_error)
+        self.assertTrue(alice.healthy)
+        self.assertEqual(self.login_server.logins, [])
+
+    def test_pool_gives_up_once_no_session_is_usable(self):
+        alice = make_session(self.dir, "alice", StaticCredentials("alice", "pw"), fallback=("expired", "c", "m", "d"))
+        server = AuthServer(accepted=set())
+        results = self.run_requests(SessionPool([alice]), server, 1)
+
+        self.assertIsInstance(results[0], LoginError)
+        self.assertEqual(self.login_server.logins, ["alice"] * alice.max_refreshes)
+        self.assertFalse(alice.healthy)
+
+    def test_success_resets_the_relogin_count_of_its_generation_only(self):
+        alice = make_session(self.dir, "alice")
+        old = alice.generation
+        alice.credentials.replace(("new", "c", "m", "d"))
+        alice.refreshes = 2
+        alice.succeeded(old)
+        self.assertEqual(alice.refreshes, 2)
+        alice.succeeded(alice.generation)
+        self.assertEqual(alice.refreshes, 0)
+
+if __name__ == "__main__":
+    unittest.main()